@@ -2,30 +2,81 @@ import requests
 import logging
 import time
 import hashlib
-import copy
+import os
+import tempfile
 from os import path, getenv
 import json
 from socket import gethostname
 from sys import exit
-import subprocess
+import threading
+import Queue
+import random
+import gzip
+from io import BytesIO
 from docker import Client
+from docker.errors import DockerException
+from requests.adapters import HTTPAdapter
 
 
 class ECSIDMapAgent():
-    def __init__(self, server_endpoint, log_level):
+    VOLATILE_FIELDS = ('sample_time',)  # id map entry fields that change without the container changing
+    # attribute -> EC2 instance metadata path
+    INSTANCE_METADATA = {'instance_ip': 'local-ipv4',
+                         'instance_id': 'instance-id',
+                         'instance_type': 'instance-type',
+                         'instance_az': 'placement/availability-zone'}
+
+    def __init__(self, server_endpoint, log_level, pool_size=4, connect_timeout=1, read_timeout=10, compress=False,
+                 debounce_ms=500, max_latency_ms=5000, report_queue_size=100, overflow_policy='drop_oldest',
+                 max_backoff_time=30, state_file=None, metadata_cache_file=None, metadata_ttl=3600,
+                 ecs_metadata_ttl=300, local_timeout=1):
         self.id_map = {}
         self.new_id_map = {}
+        self.task_entries = {}  # task arn -> (fingerprint of the task, its id map entries)
+        self.generation = 0  # generation of self.id_map as last sent to the server
+        self.container_ports = {}  # docker id -> port bindings. Bindings don't change for the life of a container
         self.server_endpoint = server_endpoint
         self.logger = self._setup_logger(log_level)
         self.backoff_time = 2
-        self.current_backoff_time = self.backoff_time
-        self.current_retry = 0
+        self.max_backoff_time = max_backoff_time
         self.max_retries = 2
+        # reports are sent by a background worker so docker event handling never waits on the server
+        self.report_queue = Queue.Queue(maxsize=report_queue_size)
+        self.overflow_policy = overflow_policy
+        self.reports_dropped = 0
+        self.state_lock = threading.Lock()  # guards id_map and generation, shared with the report worker
+        self.resynced_generation = 0  # generation of the last full map the server accepted
+        # id map and generation as last acknowledged by the server, checkpointed to state_file by the report worker
+        self.reported_map = {}
+        self.reported_generation = 0
+        self.state_file = state_file
+        self.debounce = debounce_ms / 1000.0
+        self.max_latency = max_latency_ms / 1000.0
+        self.events_received = 0
+        self.events_coalesced = 0
+        self.refreshes = 0
+        self.server_timeout = (connect_timeout, read_timeout)
+        self.local_timeout = local_timeout  # ECS agent and instance metadata, both on the instance itself
+        self.compress = compress
+        # one keep-alive session per upstream so connections are reused between reporting cycles
+        self.metadata_session = self._new_session(len(self.INSTANCE_METADATA))
+        self.ecs_agent_session = self._new_session(pool_size)
+        self.server_session = self._new_session(pool_size)
         self.hostname = gethostname()
-        self.instance_ip = self.get_instance_metadata('local-ipv4')  # set these at object constr. as they don't change
-        self.instance_id = self.get_instance_metadata('instance-id')
-        self.instance_type = self.get_instance_metadata('instance-type')
-        self.instance_az = self.get_instance_metadata('placement/availability-zone')
+        # instance and ECS agent metadata rarely change, they are cached in memory and in metadata_cache_file
+        self.metadata_cache_file = metadata_cache_file
+        self.metadata_ttl = metadata_ttl
+        self.ecs_metadata_ttl = ecs_metadata_ttl
+        for attr in self.INSTANCE_METADATA:
+            setattr(self, attr, "")
+        self.instance_metadata_time = 0
+        self.ecs_agent_metadata = None
+        self.ecs_agent_metadata_time = 0
+        self._load_metadata_cache()
+        if not self.instance_metadata_time:
+            self.refresh_instance_metadata()
+        self.host_key = self.instance_id or self.hostname
+        self._load_state()
         self.docker_client = Client(base_url='unix://var/run/docker.sock', version='1.21')
 
     @staticmethod
@@ -39,171 +90,528 @@ class ECSIDMapAgent():
         logger.addHandler(stderr_logs)
         return logger
 
-    def _retry(self):
-        self.logger.debug('backoff: {} retry: {} max_retry {}'.format(self.current_backoff_time,
-                                                                      self.current_retry, self.max_retries))
-        if self.current_retry >= self.max_retries:
+    @staticmethod
+    def _new_session(pool_size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _retry(self, attempt):
+        """
+        Sleep before the next attempt of a request, with full jitter exponential backoff
+        :param attempt: int. number of attempts made so far
+        :return: bool. False if we are out of retries
+        """
+        self.logger.debug('attempt: {} max_retry {}'.format(attempt, self.max_retries))
+        if attempt > self.max_retries:
             self.logger.info('Max _retry reached. Aborting')
-            self.current_retry = 0
-            self.current_backoff_time = self.backoff_time
             return False
-        else:
-            self.current_retry += 1
-            self.logger.info('Sleeping for {} seconds'.format(str(self.current_backoff_time)))
-            time.sleep(self.current_backoff_time)
-            self.current_backoff_time **= 2
-            return True
+        backoff_time = random.uniform(0, min(self.max_backoff_time, self.backoff_time * 2 ** (attempt - 1)))
+        self.logger.info('Sleeping for {:.2f} seconds'.format(backoff_time))
+        time.sleep(backoff_time)
+        return True
 
-    def _http_connect(self, url, timeout=1):
+    def _http_connect(self, url, session, timeout=None):
+        timeout = timeout or self.local_timeout
         self.logger.debug('Making connection to: {}'.format(url))
+        attempt = 0
         while True:
+            attempt += 1
             try:
-                r = requests.get(url, timeout=timeout)
+                r = session.get(url, timeout=timeout)
                 return r
             except requests.exceptions.ConnectionError:
                 self.logger.error('Connection error accessing URL {}'.format(str(url)))
-                if not self._retry():
+                if not self._retry(attempt):
                     return None
             except requests.exceptions.Timeout:
                 self.logger.error(
                     'Connection timeout accessing URL {}. Current timeout value {}'.format(url, str(timeout)))
-                if not self._retry():
+                if not self._retry(attempt):
                     return None
 
+    def _load_state(self):
+        """
+        Restore the id map and generation the server last acknowledged, so the first refresh after a restart only
+        reports what changed while the agent was down
+        """
+        if not self.state_file or not path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            if state['host_key'] != self.host_key:
+                self.logger.info('Ignoring agent state saved on another host ({})'.format(state['host_key']))
+                return
+            self.id_map = state['id_map']
+            self.generation = int(state['generation'])
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            self.logger.warning('Unable to load agent state from {}: {}'.format(self.state_file, e))
+            return
+        self.new_id_map = dict(self.id_map)
+        self.reported_map = dict(self.id_map)
+        self.reported_generation = self.generation
+        self.logger.info('Restored {} id map entries at generation {} from {}'.format(
+            len(self.id_map), self.generation, self.state_file))
+
+    def _write_json(self, file_path, obj):
+        """
+        Write obj to a temporary file that replaces file_path in one rename, so a crash never leaves a partial file
+        """
+        directory = path.dirname(path.abspath(file_path))
+        try:
+            if not path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + path.basename(file_path))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(obj, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, file_path)
+        except (IOError, OSError) as e:
+            self.logger.warning('Unable to write {}: {}'.format(file_path, e))
+
+    def _save_state(self):
+        """
+        Checkpoint the id map and generation the server acknowledged
+        """
+        if not self.state_file:
+            return
+        self._write_json(self.state_file, {'host_key': self.host_key,
+                                           'generation': self.reported_generation,
+                                           'id_map': self.reported_map,
+                                           'saved_at': time.time()})
+
+    def _load_metadata_cache(self):
+        """
+        Use the instance and ECS agent metadata from metadata_cache_file if it is still fresh
+        """
+        if not self.metadata_cache_file or not path.exists(self.metadata_cache_file):
+            return
+        try:
+            with open(self.metadata_cache_file) as f:
+                cache = json.load(f)
+            if cache['hostname'] != self.hostname:
+                return
+            now = time.time()
+            if now - cache['instance_time'] < self.metadata_ttl and all(cache['instance'].values()):
+                for attr, value in cache['instance'].iteritems():
+                    setattr(self, attr, str(value))
+                self.instance_metadata_time = cache['instance_time']
+            if cache['ecs_agent'] and now - cache['ecs_agent_time'] < self.ecs_metadata_ttl:
+                self.ecs_agent_metadata = cache['ecs_agent']
+                self.ecs_agent_metadata_time = cache['ecs_agent_time']
+        except (IOError, ValueError, KeyError, TypeError, AttributeError) as e:
+            self.logger.warning('Unable to load metadata cache {}: {}'.format(self.metadata_cache_file, e))
+
+    def _save_metadata_cache(self):
+        if not self.metadata_cache_file:
+            return
+        self._write_json(self.metadata_cache_file, {
+            'hostname': self.hostname,
+            'instance': dict((attr, getattr(self, attr)) for attr in self.INSTANCE_METADATA),
+            'instance_time': self.instance_metadata_time,
+            'ecs_agent': self.ecs_agent_metadata,
+            'ecs_agent_time': self.ecs_agent_metadata_time})
+
+    def refresh_instance_metadata(self):
+        """
+        Fetch the instance metadata we report, all paths concurrently. Values that couldn't be fetched keep
+        their previous value.
+        """
+        results = {}
+
+        def fetch(attr, metadata_path):
+            results[attr] = self.get_instance_metadata(metadata_path)
+        threads = [threading.Thread(target=fetch, args=item) for item in self.INSTANCE_METADATA.iteritems()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for attr, value in results.iteritems():
+            if value:
+                setattr(self, attr, value)
+        self.instance_metadata_time = time.time()
+        if all(results.values()):
+            self._save_metadata_cache()
+
+    def get_ecs_agent_metadata(self):
+        """
+        :return: dict. ECS agent metadata (cluster, version), cached for ecs_metadata_ttl seconds. None if we never
+         reached the ECS agent
+        """
+        if self.ecs_agent_metadata is None or time.time() - self.ecs_agent_metadata_time >= self.ecs_metadata_ttl:
+            r = self._http_connect('http://127.0.0.1:51678/v1/metadata', self.ecs_agent_session)
+            if r:
+                self.ecs_agent_metadata = r.json()
+                self.ecs_agent_metadata_time = time.time()
+                self._save_metadata_cache()
+        return self.ecs_agent_metadata
+
     def get_instance_metadata(self, path):
         self.logger.info('Checking instance metadata for {}'.format(path))
-        metadata = self._http_connect('http://169.254.169.254/latest/meta-data/{}'.format(path))
+        metadata = self._http_connect('http://169.254.169.254/latest/meta-data/{}'.format(path),
+                                      self.metadata_session)
         if metadata:
             return metadata.text
         else:
             return ""
 
-    @staticmethod
-    def get_container_ports(container_id):
-        try:
-            cmd = ["/usr/bin/docker", "port", container_id[:12]]
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            output, errors = p.communicate()
-            if errors or len(output) < 1:
-                return "0", "0"
-            cport, hport = output.split("-")
-            cport = cport.split('/')[0]
-            hport = hport.split(':')[1].strip()
-            return cport, hport
-        except (OSError, ValueError):
-            return "0", "0"
+    def get_container_ports(self, container_ids):
+        """
+        Get the host port bindings of running containers. Bindings are cached per container, containers we don't
+        know yet are looked up with a single docker API call.
+        :param container_ids: list. docker ids of the running containers
+        :return: dict. docker id -> list of (container port, protocol, host port) tuples
+        """
+        container_ids = set(container_ids)
+        # forget containers that are no longer running
+        for container_id in set(self.container_ports) - container_ids:
+            del self.container_ports[container_id]
+        if container_ids - set(self.container_ports):
+            try:
+                for container in self.docker_client.containers():
+                    if container['Id'] in container_ids:
+                        bindings = [(str(p['PrivatePort']), str(p.get('Type', 'tcp')), str(p['PublicPort']))
+                                    for p in container.get('Ports') or [] if p.get('PublicPort')]
+                        self.container_ports[container['Id']] = sorted(bindings, key=lambda b: int(b[0]))
+            except (DockerException, requests.exceptions.RequestException) as e:
+                self.logger.error('Unable to list containers from docker: {}'.format(e))
+        return self.container_ports
 
     def get_ecs_agent_tasks(self):
+        if time.time() - self.instance_metadata_time >= self.metadata_ttl:
+            self.refresh_instance_metadata()
         self.logger.info('Requesting data from ECS agent')
-        ecs_agent_tasks_response = self._http_connect('http://127.0.0.1:51678/v1/tasks')
-        ecs_agent_metadata_response = self._http_connect('http://127.0.0.1:51678/v1/metadata')
+        ecs_agent_tasks_response = self._http_connect('http://127.0.0.1:51678/v1/tasks', self.ecs_agent_session)
+        ecs_agent_metadata = self.get_ecs_agent_metadata()
 
-        if ecs_agent_tasks_response and ecs_agent_metadata_response:
+        if ecs_agent_tasks_response and ecs_agent_metadata:
             ecs_agent_tasks = ecs_agent_tasks_response.json()
-            ecs_agent_metadata = ecs_agent_metadata_response.json()
         else:
             ecs_agent_tasks = None
             ecs_agent_metadata = None
             return False
-        id_map = {}
         cluster_name = ecs_agent_metadata['Cluster']
         ecs_agent_version = ecs_agent_metadata['Version']
+        container_ports = self.get_container_ports(
+            [str(container['DockerId']) for task in ecs_agent_tasks['Tasks'] if task['DesiredStatus'] == "RUNNING"
+             for container in task['Containers']])
+        host_fingerprint = (cluster_name, ecs_agent_version, self.hostname,
+                            self.instance_ip, self.instance_id, self.instance_type, self.instance_az)
+        id_map = {}
+        task_entries = {}
+        reused = 0
         for task in ecs_agent_tasks['Tasks']:
-            task_id = str(task['Arn'].split(":")[-1][5:])
-            desired_status = str(task['DesiredStatus'])
-            known_status = str(task['KnownStatus'])
-            task_name = str(task['Family'])
-            task_version = str(task['Version'])
-            for container in task['Containers']:
-                docker_id = str(container['DockerId'])
-                if desired_status == "RUNNING":
-                    container_port, instance_port = self.get_container_ports(docker_id)
-                else:
-                    container_port, instance_port = "0", "0"
-                container_name = str(container['Name'])
-                pkey = hashlib.sha256()
-                pkey.update(docker_id)
-                pkey.update(task_id)
-                pkey.update(desired_status)
-                id_map[pkey.hexdigest()] = {'container_id': docker_id,
-                                            'container_name': container_name,
-                                            'container_port': container_port,
-                                            'task_id': task_id,
-                                            'task_name': task_name,
-                                            'task_version': task_version,
-                                            'instance_port': instance_port,
-                                            'instance_ip': self.instance_ip,
-                                            'instance_id': self.instance_id,
-                                            'instance_type': self.instance_type,
-                                            'instance_az': self.instance_az,
-                                            'desired_status': desired_status,
-                                            'known_status': known_status,
-                                            'host_name': self.hostname,
-                                            'cluster_name': cluster_name,
-                                            'ecs_agent_version': ecs_agent_version,
-                                            'sample_time': time.time()}
-        # Update internal state
-        self.new_id_map = copy.deepcopy(id_map)
-
-    def report_event(self, event_id, action):
-        for id in event_id:
-            self.logger.info('Reporting new container event. Action {}. Event id: {}'.format(action, id))
-            headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
-            while True:
-                try:
-                    r = requests.post(path.join(self.server_endpoint, 'report/event'),
-                                      headers=headers,
-                                      data=json.dumps({'event_id': id, 'event': action, 'timestamp': time.time()}))
-                    self.logger.debug("HTTP response: " + str(r.status_code))
-                    break
-                except requests.exceptions.ConnectionError:
-                    self.logger.info('Unable to connect to server endpoint. Sleeping for {} seconds'.format(
-                        str(self.current_backoff_time)))
-                    if not self._retry():
-                        break
+            desired_status = task['DesiredStatus']
+            # everything the entries of the task are built from, if it didn't change neither did the entries
+            fingerprint = (host_fingerprint, desired_status, task['KnownStatus'], task['Family'], task['Version'],
+                           tuple((container['DockerId'], container['Name'],
+                                  tuple(container_ports.get(str(container['DockerId']), []))
+                                  if desired_status == "RUNNING" else ())
+                                 for container in task['Containers']))
+            cached = self.task_entries.get(task['Arn'])
+            if cached and cached[0] == fingerprint:
+                entries = cached[1]
+                reused += 1
+            else:
+                entries = self._build_task_entries(task, cluster_name, ecs_agent_version, container_ports)
+            task_entries[task['Arn']] = (fingerprint, entries)
+            id_map.update(entries)
+        self.logger.debug('Reused the id map entries of {} of {} tasks'.format(reused, len(task_entries)))
+        # Update internal state. Entries are never modified once built, so they are shared rather than copied
+        self.task_entries = task_entries
+        self.new_id_map = id_map
 
-    def report_map(self):
-        self.logger.info('Reporting current id map')
+    def _build_task_entries(self, task, cluster_name, ecs_agent_version, container_ports):
+        """
+        Build the id map entries of the containers of a task. Where an entry has the same content as the one we
+        last reported, that entry is reused, so it keeps its sample_time and compare_hash sees it as unchanged.
+        :param task: dict. task as listed by the ECS agent
+        :return: dict. id map key -> entry
+        """
+        entries = {}
+        task_id = str(task['Arn'].split(":")[-1][5:])
+        desired_status = str(task['DesiredStatus'])
+        known_status = str(task['KnownStatus'])
+        task_name = str(task['Family'])
+        task_version = str(task['Version'])
+        for container in task['Containers']:
+            docker_id = str(container['DockerId'])
+            port_bindings = container_ports.get(docker_id, []) if desired_status == "RUNNING" else []
+            if port_bindings:
+                container_port, _, instance_port = port_bindings[0]
+            else:
+                container_port, instance_port = "0", "0"
+            container_name = str(container['Name'])
+            pkey = hashlib.sha256()
+            pkey.update(docker_id)
+            pkey.update(task_id)
+            pkey.update(desired_status)
+            key = pkey.hexdigest()
+            entry = {'container_id': docker_id,
+                     'container_name': container_name,
+                     'container_port': container_port,
+                     'task_id': task_id,
+                     'task_name': task_name,
+                     'task_version': task_version,
+                     'instance_port': instance_port,
+                     'port_mappings': ','.join('{}/{}:{}'.format(*b) for b in port_bindings),
+                     'instance_ip': self.instance_ip,
+                     'instance_id': self.instance_id,
+                     'instance_type': self.instance_type,
+                     'instance_az': self.instance_az,
+                     'desired_status': desired_status,
+                     'known_status': known_status,
+                     'host_name': self.hostname,
+                     'cluster_name': cluster_name,
+                     'ecs_agent_version': ecs_agent_version}
+            reported = self.id_map.get(key)
+            if reported is not None and self._same_content(entry, reported):
+                entries[key] = reported
+            else:
+                entry['sample_time'] = time.time()
+                entries[key] = entry
+        return entries
+
+    def _same_content(self, entry, other):
+        """
+        :return: bool. True if two id map entries only differ in volatile fields
+        """
+        keys = set(entry) | set(other)
+        return all(entry.get(k) == other.get(k) for k in keys if k not in self.VOLATILE_FIELDS)
+
+    def _post_server(self, endpoint, payload, params=None):
+        """
+        POST a json payload to the server, gzip compressed if enabled
+        :param endpoint: str. path of the server method, e.g. 'report/map'
+        :param payload: json serializable object
+        :param params: dict. query string parameters
+        :return: requests.Response. None if the server couldn't be reached
+        """
         headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
+        data = json.dumps(payload)
+        if self.compress:
+            buf = BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                f.write(data)
+            data = buf.getvalue()
+            headers['Content-Encoding'] = 'gzip'
+        attempt = 0
         while True:
+            attempt += 1
             try:
-                r = requests.post(path.join(self.server_endpoint, 'report/map'),
-                                  headers=headers, data=json.dumps(self.id_map))
+                r = self.server_session.post(path.join(self.server_endpoint, endpoint),
+                                             params=params, headers=headers, data=data,
+                                             timeout=self.server_timeout)
                 self.logger.debug("HTTP response: " + str(r.status_code))
-                break
-            except requests.exceptions.ConnectionError:
-                self.logger.info('Unable to connect to server endpoint. Sleeping for {} seconds'.format(
-                    str(self.current_backoff_time)))
-                if not self._retry():
-                    break
+                return r
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self.logger.info('Unable to connect to server endpoint')
+                if not self._retry(attempt):
+                    return None
+
+    def _enqueue_report(self, kind, payload):
+        """
+        Queue a report for the report worker. When the queue is full the overflow policy decides whether the
+        oldest queued report is dropped (drop_oldest), this report is dropped (drop_newest) or we wait (block).
+        A dropped map delta leaves a generation gap which the server answers with a resync request.
+        :param kind: str. 'events' or 'map_delta'
+        :param payload: report payload
+        """
+        while True:
+            try:
+                self.report_queue.put((kind, payload), block=self.overflow_policy == 'block')
+                return
+            except Queue.Full:
+                self.reports_dropped += 1
+                if self.overflow_policy == 'drop_newest':
+                    self.logger.warning('Report queue full, dropping {} report'.format(kind))
+                    return
+                try:
+                    dropped_kind, _ = self.report_queue.get_nowait()
+                    self.report_queue.task_done()
+                    self.logger.warning('Report queue full, dropping oldest {} report'.format(dropped_kind))
+                except Queue.Empty:
+                    pass
+
+    def _report_worker(self):
+        """
+        Send queued reports to the server, in order. Runs in its own thread.
+        """
+        while True:
+            kind, payload = self.report_queue.get()
+            try:
+                if kind == 'events':
+                    self._post_server('report/events', payload)
+                elif kind == 'map_delta':
+                    self._send_map_delta(payload)
+            except Exception:
+                self.logger.exception('Unexpected error sending {} report'.format(kind))
+            finally:
+                self.report_queue.task_done()
+
+    def report_events(self, events):
+        """
+        Queue a batch of container events to be reported in one request
+        :param events: list. (event id, action, id map entry) tuples
+        """
+        self.logger.info('Reporting {} container events'.format(len(events)))
+        timestamp = time.time()
+        self._enqueue_report('events',
+                             [{'event_id': id, 'event': action, 'timestamp': timestamp,
+                               'container_id': entry['container_id'],
+                               'task_id': entry['task_id'],
+                               'task_name': entry['task_name']} for id, action, entry in events])
+
+    def report_map(self):
+        with self.state_lock:
+            id_map = self.id_map
+            generation = self.generation
+        self.logger.info('Reporting current id map. Generation {}'.format(generation))
+        r = self._post_server('report/map', id_map, params={'host': self.host_key, 'generation': generation})
+        if r is not None and r.status_code == 200:
+            self.resynced_generation = generation
+            self.reported_map = dict(id_map)
+            self.reported_generation = generation
+            self._save_state()
+
+    def report_map_delta(self, id_map, containers_added, containers_removed, containers_changed=()):
+        """
+        Make id_map the current id map and queue the entries that changed since the last generation we reported
+        :param id_map: dict. the new id map
+        :param containers_added: set. keys of id_map that are new
+        :param containers_removed: set. keys that are no longer in id_map
+        :param containers_changed: set. keys of id_map whose attributes changed
+        """
+        with self.state_lock:
+            self.id_map = id_map
+            base_generation = self.generation
+            self.generation += 1
+            delta = {'host': self.host_key,
+                     'generation': self.generation,
+                     'base_generation': base_generation,
+                     'added': dict((k, id_map[k]) for k in containers_added),
+                     'changed': dict((k, id_map[k]) for k in containers_changed),
+                     'removed': list(containers_removed)}
+        self.logger.info('Reporting id map delta. Generation {}'.format(delta['generation']))
+        # queued without state_lock held: with the block overflow policy this waits for the report worker, which
+        # needs state_lock to send the full map when the server asks for a resync
+        self._enqueue_report('map_delta', delta)
+
+    def _send_map_delta(self, delta):
+        """
+        Send a map delta. Falls back to reporting the full map if the server doesn't hold the generation the
+        delta is based on.
+        :param delta: dict. as built by report_map_delta
+        """
+        if delta['generation'] <= self.resynced_generation:
+            self.logger.debug('Skipping delta {}, already covered by a full map'.format(delta['generation']))
+            return
+        r = self._post_server('report/map/delta', delta)
+        if r is not None and r.status_code == 409:
+            self.logger.info('Server requested a full resync of the id map')
+            self.report_map()
+        elif r is not None and r.status_code == 200:
+            self.reported_map.update(delta['added'])
+            self.reported_map.update(delta['changed'])
+            for k in delta['removed']:
+                self.reported_map.pop(k, None)
+            self.reported_generation = delta['generation']
+            self._save_state()
 
     def compare_hash(self):
         self.logger.info('Comparing known state to current state')
         containers_added = set(self.new_id_map.keys()) - set(self.id_map.keys())
         containers_removed = set(self.id_map.keys()) - set(self.new_id_map.keys())
+        # unchanged entries are reused by get_ecs_agent_tasks, anything else is a different object
+        containers_changed = set(k for k in set(self.new_id_map.keys()) & set(self.id_map.keys())
+                                 if self.new_id_map[k] is not self.id_map[k])
+        events = []
         if len(containers_added) > 0:
             self.logger.info('Containers added {}'.format(containers_added))
-            self.report_event(containers_added, 'added')
+            events.extend((id, 'added', self.new_id_map[id]) for id in containers_added)
         if len(containers_removed) > 0:
             self.logger.info('Containers removed {}'.format(containers_removed))
-            self.report_event(containers_removed, 'removed')
-        if len(containers_removed) > 0 or len(containers_added) > 0:
-            self.id_map = copy.deepcopy(self.new_id_map)
-            self.report_map()
+            events.extend((id, 'removed', self.id_map[id]) for id in containers_removed)
+        if len(events) > 0:
+            self.report_events(events)
+        if len(containers_changed) > 0:
+            self.logger.info('Containers changed {}'.format(containers_changed))
+        if len(containers_removed) > 0 or len(containers_added) > 0 or len(containers_changed) > 0:
+            self.report_map_delta(self.new_id_map, containers_added, containers_removed, containers_changed)
         else:
             self.logger.info('No container actions to report')
 
+    def _consume_docker_events(self, events):
+        """
+        Put docker container start/die events on the events queue. Puts None when the event stream ends.
+        :param events: Queue.Queue.
+        """
+        try:
+            for event in self.docker_client.events(decode=True):
+                self.logger.debug(str(event))
+                if event['status'] == 'start' or event['status'] == 'die':
+                    events.put(event)
+        finally:
+            events.put(None)
+
+    def _wait_for_quiet(self, events):
+        """
+        Collapse a burst of events into one: wait until no event arrived for the debounce window, or until
+        max latency has passed since the first event of the burst
+        :param events: Queue.Queue.
+        :return: tuple. (number of events coalesced, bool. True if the event stream ended)
+        """
+        coalesced = 0
+        deadline = time.time() + self.max_latency
+        while True:
+            now = time.time()
+            if now >= deadline:
+                return coalesced, False
+            try:
+                if self.debounce > 0:
+                    event = events.get(timeout=min(self.debounce, deadline - now))
+                else:
+                    event = events.get_nowait()
+            except Queue.Empty:
+                return coalesced, False
+            if event is None:
+                return coalesced, True
+            coalesced += 1
+
     def run(self):
         """
         Blocking method to run agent
         :return:
         """
         self.logger.info('Starting agent')
-        for event in self.docker_client.events(decode=True):
-            self.logger.debug(str(event))
-            if event['status'] == 'start' or event['status'] == 'die':
-                agent.get_ecs_agent_tasks()
-                agent.compare_hash()
+        events = Queue.Queue()
+        consumer = threading.Thread(target=self._consume_docker_events, args=(events,), name='docker_events')
+        consumer.daemon = True
+        consumer.start()
+        reporter = threading.Thread(target=self._report_worker, name='report_worker')
+        reporter.daemon = True
+        reporter.start()
+        # report whatever changed while the agent wasn't running
+        self.get_ecs_agent_tasks()
+        self.compare_hash()
+        stream_ended = False
+        while not stream_ended:
+            if events.get() is None:
+                break
+            coalesced, stream_ended = self._wait_for_quiet(events)
+            self.events_received += coalesced + 1
+            self.events_coalesced += coalesced
+            self.refreshes += 1
+            self.logger.info('Refreshing after {} events. Totals: {} events, {} coalesced, {} refreshes'.format(
+                coalesced + 1, self.events_received, self.events_coalesced, self.refreshes))
+            self.get_ecs_agent_tasks()
+            self.compare_hash()
+        self.logger.info('Docker event stream ended. Waiting for queued reports to be sent')
+        self.report_queue.join()
 
 
 if __name__ == '__main__':
@@ -214,7 +622,22 @@ if __name__ == '__main__':
         print "Error: you must specify server endpoint as EVAR 'endpoint'"
         exit(1)
 
-    agent = ECSIDMapAgent(server_endpoint, log_level)
+    agent = ECSIDMapAgent(server_endpoint, log_level,
+                          pool_size=int(getenv('http_pool_size', 4)),
+                          connect_timeout=float(getenv('http_connect_timeout', 1)),
+                          read_timeout=float(getenv('http_read_timeout', 10)),
+                          compress=getenv('http_compress', 'false') == 'true',
+                          debounce_ms=int(getenv('debounce_ms', 500)),
+                          max_latency_ms=int(getenv('max_latency_ms', 5000)),
+                          report_queue_size=int(getenv('report_queue_size', 100)),
+                          overflow_policy=getenv('report_overflow_policy', 'drop_oldest'),
+                          max_backoff_time=float(getenv('max_backoff_time', 30)),
+                          state_file=getenv('state_file', '/var/lib/ecs_id_mapper_agent/state.json') or None,
+                          metadata_cache_file=getenv('metadata_cache_file',
+                                                     '/var/lib/ecs_id_mapper_agent/metadata.json') or None,
+                          metadata_ttl=float(getenv('metadata_ttl', 3600)),
+                          ecs_metadata_ttl=float(getenv('ecs_metadata_ttl', 300)),
+                          local_timeout=float(getenv('local_http_timeout', 1)))
 
     # Reduce verbosity of requests logging
     logging.getLogger("requests").setLevel(logging.WARNING)
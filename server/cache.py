@@ -0,0 +1,193 @@
+from collections import OrderedDict
+import threading
+import time
+import logging
+
+logger = logging.getLogger('ecs_id_mapper')
+
+
+class CachedItem(dict):
+    """
+    dict of container attributes that, like a boto sdb Item, carries its item name in .name
+    """
+    def __init__(self, name, attrs):
+        super(CachedItem, self).__init__(attrs)
+        self.name = name
+
+
+class MapCache(object):
+    """
+    In-memory LRU/TTL cache of rows from the hash domain, indexed by container_id, short (12 char)
+    container id and task_id. Rows are keyed by their item name so a write to an existing item replaces
+    the cached copy and keeps the indexes consistent.
+    A container or task is only answered from the cache once the complete set of its rows was cached with
+    put_container_rows/put_task_rows, and only while all of those rows are still cached, so a lookup never returns
+    part of the rows after some were evicted. Writes and deletes are only seen by the process that makes them,
+    other processes serve their cached rows until the ttl expires.
+    """
+    def __init__(self, max_entries=10000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._rows = OrderedDict()  # item name -> (expiry, CachedItem), oldest first
+        self._indexes = {'container_id': {}, 'short_id': {}, 'task_id': {}}
+        # (index, value) -> expiry of lookups cached with all their rows, oldest first. An entry is dropped as soon
+        # as one of its rows is evicted or expires
+        self._complete = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _index_values(attrs):
+        container_id = attrs.get('container_id')
+        return {'container_id': container_id,
+                'short_id': container_id[:12] if container_id else None,
+                'task_id': attrs.get('task_id')}
+
+    def _unindex(self, name, incomplete=False):
+        """
+        :param incomplete: bool. the row is dropped from the cache but still exists, lookups it belongs to can no
+         longer be answered from the cache. Otherwise the row is gone or moved to other index values.
+        """
+        expiry, row = self._rows.pop(name)
+        for index, value in self._index_values(row).iteritems():
+            names = self._indexes[index].get(value)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self._indexes[index][value]
+            if incomplete:
+                self._complete.pop((index, value), None)
+        return row
+
+    def put(self, name, attrs):
+        """
+        Add or replace a row in the cache
+        :param name: str. item name of the row
+        :param attrs: dict. attributes of the row
+        """
+        with self._lock:
+            if name in self._rows:
+                self._unindex(name)
+            row = CachedItem(name, attrs)
+            self._rows[name] = (time.time() + self.ttl, row)
+            for index, value in self._index_values(row).iteritems():
+                if value:
+                    self._indexes[index].setdefault(value, set()).add(name)
+            while len(self._rows) > self.max_entries:
+                self._unindex(next(iter(self._rows)), incomplete=True)
+                self.evictions += 1
+
+    def put_many(self, rows):
+        """
+        :param rows: dict. item name -> attributes, as passed to db.batch_put
+        """
+        for name, attrs in rows.iteritems():
+            self.put(name, attrs)
+
+    def _put_complete(self, index, value, rows):
+        with self._lock:
+            for row in rows:
+                self.put(row.name, row)
+            # a result larger than the cache evicts its own rows
+            if rows and all(row.name in self._rows for row in rows):
+                self._complete.pop((index, value), None)
+                self._complete[(index, value)] = time.time() + self.ttl
+                while len(self._complete) > self.max_entries:
+                    self._complete.popitem(last=False)
+
+    def put_container_rows(self, container_id, rows):
+        """
+        Cache all the rows of a container, as read from the DB
+        :param container_id: str. full container id, or the 12 char short form
+        :param rows: list. every row of the container
+        """
+        if len(container_id) == 12:
+            self._put_complete('short_id', container_id, rows)
+        elif len(container_id) > 12:
+            self._put_complete('container_id', container_id, rows)
+        else:
+            for row in rows:
+                self.put(row.name, row)
+
+    def put_task_rows(self, task_id, rows):
+        """
+        Cache all the rows of a task, as read from the DB
+        :param task_id: str.
+        :param rows: list. every row of the task
+        """
+        self._put_complete('task_id', task_id, rows)
+
+    def update(self, name, attrs):
+        """
+        Merge attributes into a cached row, if we have it
+        """
+        with self._lock:
+            if name in self._rows:
+                row = dict(self._rows[name][1])
+                row.update(attrs)
+                self.put(name, row)
+
+    def invalidate(self, name):
+        with self._lock:
+            if name in self._rows:
+                self._unindex(name)
+
+    def _lookup(self, index, value):
+        with self._lock:
+            now = time.time()
+            rows = []
+            expiry = self._complete.get((index, value))
+            if expiry is not None and expiry < now:
+                del self._complete[(index, value)]
+            elif expiry is not None:
+                for name in list(self._indexes[index].get(value, ())):
+                    expiry, row = self._rows[name]
+                    if expiry < now:
+                        self._unindex(name, incomplete=True)
+                        continue
+                    self._rows[name] = self._rows.pop(name)  # mark as most recently used
+                    rows.append(row)
+                if (index, value) not in self._complete:
+                    rows = []
+            if rows:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return rows
+
+    def get(self, name):
+        """
+        :param name: str. item name of the row
+        :return: CachedItem. None on a cache miss
+        """
+        with self._lock:
+            entry = self._rows.get(name)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def get_by_container_id(self, container_id):
+        """
+        :param container_id: str. full container id, or the 12 char short form
+        :return: list. cached rows, empty on a cache miss
+        """
+        if len(container_id) == 12:
+            return self._lookup('short_id', container_id)
+        return self._lookup('container_id', container_id)
+
+    def get_by_task_id(self, task_id):
+        return self._lookup('task_id', task_id)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._rows),
+                    'max_entries': self.max_entries,
+                    'ttl': self.ttl,
+                    'complete_lookups': len(self._complete),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
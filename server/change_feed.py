@@ -0,0 +1,94 @@
+from collections import deque
+from itertools import islice
+import threading
+import time
+
+
+class ChangeFeed(object):
+    """
+    Ring buffer of the most recent changes to the map. Every change gets the next sequence number so subscribers
+    can resume from the last one they saw; readers block until there is something newer.
+    """
+    def __init__(self, size, max_subscribers=None):
+        """
+        :param size: int. number of changes kept, subscribers that fall further behind have to resync
+        :param max_subscribers: int. max number of subscribers waiting on the feed at once, None for no limit
+        """
+        self.epoch = int(time.time() * 1000)  # identifies this feed, sequence numbers restart with the server
+        self._changes = deque(maxlen=size)
+        self._cond = threading.Condition()
+        self.seq = 0
+        self.published = 0
+        self.waiting = 0
+        self.max_subscribers = max_subscribers
+        self.subscribers = 0
+        self.subscribers_refused = 0
+        self._subscribers_lock = threading.Lock()
+
+    def publish(self, changes):
+        """
+        :param changes: list. dicts describing changes, each is given a 'seq'
+        """
+        if not changes:
+            return
+        with self._cond:
+            for change in changes:
+                self.seq += 1
+                change['seq'] = self.seq
+                self._changes.append(change)
+            self.published += len(changes)
+            self._cond.notify_all()
+
+    def read(self, since, limit, timeout):
+        """
+        Changes after sequence number since, waiting up to timeout seconds for one if there are none yet
+        :param since: int. last sequence number the subscriber has seen, 0 for everything still buffered
+        :param limit: int. max number of changes to return
+        :param timeout: float. seconds
+        :return: tuple. (list of changes, bool. True if changes after since were already dropped from the buffer
+         or since is from before a restart, so the subscriber has to resync)
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            self.waiting += 1
+            try:
+                while self.seq == since:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if since > self.seq:
+                    return [], True
+                oldest = self._changes[0]['seq'] if self._changes else self.seq + 1
+                gap = since + 1 < oldest
+                # sequence numbers in the buffer are consecutive
+                start = max(since + 1 - oldest, 0)
+                return list(islice(self._changes, start, start + limit)), gap
+            finally:
+                self.waiting -= 1
+
+    def subscribe(self):
+        """
+        Take a subscriber slot, call unsubscribe once the subscriber is done waiting on the feed
+        :return: bool. False if max_subscribers are already subscribed
+        """
+        with self._subscribers_lock:
+            if self.max_subscribers is not None and self.subscribers >= self.max_subscribers:
+                self.subscribers_refused += 1
+                return False
+            self.subscribers += 1
+            return True
+
+    def unsubscribe(self):
+        with self._subscribers_lock:
+            self.subscribers -= 1
+
+    def stats(self):
+        with self._cond:
+            return {'seq': self.seq,
+                    'buffered': len(self._changes),
+                    'published': self.published,
+                    'waiting': self.waiting,
+                    'subscribers': self.subscribers,
+                    'max_subscribers': self.max_subscribers,
+                    'subscribers_refused': self.subscribers_refused}
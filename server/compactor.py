@@ -0,0 +1,169 @@
+from itertools import islice
+import threading
+import time
+import logging
+import db
+import event_partitions
+
+logger = logging.getLogger('ecs_id_mapper')
+
+
+def row_bytes(row):
+    """
+    Approximate storage used by a row, the way SimpleDB accounts for it: the raw bytes plus 45 bytes for the item,
+    each attribute name and each value
+    """
+    return 45 + len(row.name) + sum(90 + len(k) + len(unicode(v)) for k, v in row.iteritems())
+
+
+class Compactor(object):
+    """
+    Background job that keeps the domains from growing forever. Map entries of stopped containers are deleted once
+    they haven't been reported for stopped_retention seconds, and event partitions that ended more than
+    partition_retention seconds ago are dropped. Events older than event_retention seconds left in the events
+    domain by servers that didn't partition events are moved to monthly archive domains
+    (<events domain>_archive_<YYYYMM>). Rows are deleted in batches, at no more than delete_rate rows per second
+    so compaction leaves the SimpleDB request budget to the request path.
+    """
+    def __init__(self, hash_domain, events_domain, stopped_retention, event_retention, partition_retention,
+                 interval=3600, batch_size=25, delete_rate=50, max_rows=10000, on_delete=None):
+        """
+        :param hash_domain: str. domain of the map entries
+        :param events_domain: str. domain of the events
+        :param stopped_retention: float. seconds map entries of stopped containers are kept
+        :param event_retention: float. seconds events in the events domain are kept before they are archived
+        :param partition_retention: float. seconds event partitions are kept after they end
+        :param interval: float. seconds between runs
+        :param batch_size: int. rows per delete
+        :param delete_rate: float. max rows deleted per second
+        :param max_rows: int. max rows of each kind handled per run, the rest is left for the next one
+        :param on_delete: function. called with the list of map entries after they were deleted
+        """
+        self.hash_domain = hash_domain
+        self.events_domain = events_domain
+        self.stopped_retention = stopped_retention
+        self.event_retention = event_retention
+        self.partition_retention = partition_retention
+        self.interval = interval
+        self.batch_size = batch_size
+        self.delete_rate = delete_rate
+        self.max_rows = max_rows
+        self.on_delete = on_delete
+        self.rows_deleted = 0
+        self.events_archived = 0
+        self.partitions_dropped = 0
+        self.bytes_reclaimed = 0
+        self.errors = 0
+        self.last_run = None
+        self.last_run_duration = 0
+        self._thread = None
+
+    def _in_batches(self, rows, process):
+        """
+        Call process with batches of rows, pausing between batches to stay under delete_rate
+        """
+        for i in range(0, len(rows), self.batch_size):
+            batch = rows[i:i + self.batch_size]
+            process(batch)
+            self.bytes_reclaimed += sum(row_bytes(row) for row in batch)
+            time.sleep(len(batch) / float(self.delete_rate))
+
+    def expire_stopped(self):
+        """
+        Delete the map entries of containers that have been stopped for longer than stopped_retention. Each status
+        of a container is stored in its own entry, all of them go once the STOPPED one expires, unless one of them
+        was reported after the cutoff.
+        """
+        cutoff = time.time() - self.stopped_retention
+        container_ids = set(row['container_id'] for row in islice(
+            db.find_by_sample_time(0, cutoff, self.hash_domain, desired_status='STOPPED'), self.max_rows)
+            if 'container_id' in row)
+        rows_by_container = {}
+        for row in db.find_by_container_ids(container_ids, self.hash_domain):
+            rows_by_container.setdefault(row['container_id'], []).append(row)
+        rows = []
+        for container_rows in rows_by_container.itervalues():
+            if all(float(row.get('sample_time', 0)) <= cutoff for row in container_rows):
+                rows.extend(container_rows)
+
+        def delete(batch):
+            db.batch_delete([row.name for row in batch], self.hash_domain)
+            self.rows_deleted += len(batch)
+            if self.on_delete:
+                self.on_delete(batch)
+        self._in_batches(rows, delete)
+        return len(rows)
+
+    def archive_domain(self, timestamp):
+        return '{}_archive_{}'.format(self.events_domain, time.strftime('%Y%m', time.gmtime(timestamp)))
+
+    def archive_events(self):
+        """
+        Move events older than event_retention to the archive domain of the month they happened in
+        """
+        cutoff = time.time() - self.event_retention
+        rows = list(islice(db.find_by_timestamp(0, cutoff, self.events_domain), self.max_rows))
+
+        def archive(batch):
+            partitions = {}
+            for row in batch:
+                partitions.setdefault(self.archive_domain(float(row['timestamp'])), {})[row.name] = dict(row)
+            for domain, items in partitions.iteritems():
+                db.batch_put(items, domain)
+            # only delete once the batch is archived, a failure in between leaves a copy in both domains
+            db.batch_delete([row.name for row in batch], self.events_domain)
+            self.events_archived += len(batch)
+        self._in_batches(rows, archive)
+        return len(rows)
+
+    def drop_partitions(self):
+        """
+        Delete event partitions that ended more than partition_retention ago
+        """
+        cutoff = time.time() - self.partition_retention
+        dropped = 0
+        for domain in db.list_domains():
+            start = event_partitions.partition_start(domain)
+            if start is not None and start + event_partitions.partition_size() <= cutoff:
+                logger.info('Dropping event partition {}'.format(domain))
+                db.delete_domain(domain)
+                event_partitions.partition_dropped(domain)
+                dropped += 1
+        self.partitions_dropped += dropped
+        return dropped
+
+    def run_once(self):
+        start = time.time()
+        expired = self.expire_stopped()
+        dropped = self.drop_partitions()
+        archived = self.archive_events()
+        self.last_run = time.time()
+        self.last_run_duration = self.last_run - start
+        logger.info('Compaction deleted {} stopped map entries, dropped {} event partitions and archived {} events '
+                    'in {:.1f}s'.format(expired, dropped, archived, self.last_run_duration))
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                self.errors += 1
+                logger.exception('Error compacting domains')
+            time.sleep(self.interval)
+
+    def start(self):
+        """
+        Start the compactor thread
+        """
+        self._thread = threading.Thread(target=self._run, name='compactor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stats(self):
+        return {'rows_deleted': self.rows_deleted,
+                'events_archived': self.events_archived,
+                'partitions_dropped': self.partitions_dropped,
+                'bytes_reclaimed': self.bytes_reclaimed,
+                'errors': self.errors,
+                'last_run': self.last_run,
+                'last_run_duration': self.last_run_duration}
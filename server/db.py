@@ -1,110 +1,154 @@
-import boto.sdb
-from boto.exception import SDBResponseError
-from itertools import islice
+"""
+Storage interface of the server. Calls are passed on to the backend chosen with settings.storage_backend:
+'simpledb' (sdb_backend, AWS SimpleDB) or 'sqlite' (sqlite_backend, a local database with indexes on
+container_id, task_id, task_name and time attributes).
+Items are returned as dicts of attributes with the item name in .name.
+"""
 import settings
-import logging
-
-logger = logging.getLogger('ecs_id_mapper')
-
-conn = boto.sdb.connect_to_region(settings.simpledb_aws_region,
-                                  aws_access_key_id=settings.aws_id,
-                                  aws_secret_access_key=settings.aws_secret_key)
-
-# maintain state of existing domain objects
-domains = {}
-
-
-def _get_domain(domain):
-    """
-    Check if I have the domain object in local state, if not create one, and if the domain does
-    not exist, make a create_domain call and return the domain obj.
-    :param domain: str. name of the domain to get
-    :return: domain obj.
-    """
-    assert type(domain) == str
-    try:
-        _dom = domains[domain]
-    except KeyError:
-        try:
-            _dom = conn.get_domain(domain)
-        except SDBResponseError as e:
-            if str(e.error_code) == 'NoSuchDomain':
-                logger.info('Domain {dom} does not exist, creating...'.format(dom=domain))
-                # The domain doesn't exist
-                # create the domain
-                conn.create_domain(domain)
-                # get the domain object
-                _dom = conn.get_domain(domain)
-                # store domain obj for later use
-                domains[domain] = _dom
-            else:
-                # something else happened that we don't know how to handle
-                raise
-    # finally, return domain
-    return _dom
-
-
-def _batch_items(items, increment=25):
-    """
-    generator that returns a dictionary of a specified size of keys
-    :param items: dict. dictionary to batch
-    :param increment: int. qty of keys per batch
-    :return: dict. batched results
-    """
-    assert type(items) == dict
-    assert type(increment) == int
-    start = 0
-    end = increment
-    incr = increment
-    r = {}
-    while True:
-        for k,v in islice(items.iteritems(), start, end):
-            r[k] = v
-        if len(r) > 0:
-            yield r
-            start = end+1
-            end += incr
-            r = {}
-        else:
-            break
-
-
-def put(key, value, domain, replace=False):
-    dom = _get_domain(domain)
-    return dom.put_attributes(key, value, replace=replace)
+
+if settings.storage_backend == 'simpledb':
+    import sdb_backend as backend
+elif settings.storage_backend == 'sqlite':
+    import sqlite_backend as backend
+else:
+    raise Exception('Unknown storage backend {}'.format(settings.storage_backend))
 
 
 def batch_put(items, domain):
-    dom = _get_domain(domain)
-    for items in _batch_items(items):
-        dom.batch_put_attributes(items)
-    return True
+    """
+    :param items: dict. item name -> attributes
+    :param domain: str. name of the domain to write to
+    """
+    return backend.batch_put(items, domain)
 
 
 def get(key, domain, consistent_read=True):
-    dom = _get_domain(domain)
-    return dom.get_item(key, consistent_read=consistent_read)
+    """
+    :return: item. None if the key doesn't exist
+    """
+    return backend.get(key, domain, consistent_read=consistent_read)
 
 
 def get_all_dom(domain):
-    dom = _get_domain(domain)
-    return dom.select('select * from `{dom}`'.format(dom=domain))
+    return backend.get_all_dom(domain)
 
 
-def search_domain(query, domain):
-    dom =_get_domain(domain)
-    return dom.select(query)
+def del_key(key, domain):
+    return backend.del_key(key, domain)
 
 
-def del_key(key, domain):
-    dom = _get_domain(domain)
-    return dom.delete_item(get(key, domain))
+def batch_delete(keys, domain):
+    """
+    :param keys: list. names of the items to delete
+    :param domain: str. name of the domain to delete from
+    """
+    return backend.batch_delete(keys, domain)
+
+
+def find_by_container_id(container_id, domain):
+    return backend.find_by_container_id(container_id, domain)
+
+
+def find_by_container_prefix(prefix, domain):
+    """
+    :param prefix: str. start of a container id, e.g. the 12 char short id
+    """
+    return backend.find_by_container_prefix(prefix, domain)
+
+
+def find_by_container_ids(container_ids, domain):
+    """
+    :param container_ids: list. full container ids, any number of them
+    """
+    return backend.find_by_container_ids(container_ids, domain)
+
+
+def find_by_task_id(task_id, domain):
+    return backend.find_by_task_id(task_id, domain)
+
+
+def find_by_task_ids(task_ids, domain):
+    """
+    :param task_ids: list. task ids, any number of them
+    """
+    return backend.find_by_task_ids(task_ids, domain)
+
+
+def find_by_task_name(task_name, domain):
+    return backend.find_by_task_name(task_name, domain)
+
+
+def find_by_sample_time(start, end, domain, desired_status=None):
+    """
+    :param start: float. epoch time, inclusive
+    :param end: float. epoch time, inclusive
+    :param desired_status: str. only items with this desired_status, None for all
+    """
+    return backend.find_by_sample_time(start, end, domain, desired_status=desired_status)
+
+
+def find_page(attribute, values, domain, limit, cursor=None):
+    """
+    One page of the items whose attribute is one of values, for paging through large result sets
+    :param attribute: str. 'container_id', 'task_id' or 'container_prefix' (values are container id prefixes)
+    :param values: list. at most settings.sdb_max_in_values values
+    :param limit: int. max number of items in the page, at most settings.sdb_max_select_limit
+    :param cursor: str. cursor returned with the previous page, None for the first page
+    :return: tuple. (list of items, cursor of the next page or None if this is the last page)
+    """
+    return backend.find_page(attribute, values, domain, limit, cursor=cursor)
+
+
+def select_page(domain, limit, cursor=None, cluster_name=None, desired_status=None):
+    """
+    One page of the items of a domain, for streaming a whole domain
+    :param limit: int. max number of items in the page, at most settings.sdb_max_select_limit
+    :param cursor: str. cursor returned with the previous page, None for the first page
+    :param cluster_name: str. only items of this cluster, None for all
+    :param desired_status: str. only items with this desired_status, None for all
+    :return: tuple. (list of items, cursor of the next page or None if this is the last page)
+    """
+    return backend.select_page(domain, limit, cursor=cursor, cluster_name=cluster_name,
+                               desired_status=desired_status)
+
+
+def find_by_timestamp(start, end, domain):
+    """
+    :param start: float. epoch time, inclusive
+    :param end: float. epoch time, inclusive
+    """
+    return backend.find_by_timestamp(start, end, domain)
+
+
+def find_events(attribute, value, start, end, domain, limit, cursor=None):
+    """
+    One page of the items of an event domain with attribute equal to value and a timestamp in [start, end],
+    oldest first
+    :param attribute: str. 'container_id', 'task_id' or 'task_name'
+    :param limit: int. max number of items in the page, at most settings.sdb_max_select_limit
+    :param cursor: str. cursor returned with the previous page, None for the first page
+    :return: tuple. (list of items, cursor of the next page or None if this is the last page)
+    """
+    return backend.find_events(attribute, value, start, end, domain, limit, cursor=cursor)
+
+
+def all_container_ids(domain):
+    return backend.all_container_ids(domain)
 
 
 def list_domains():
-    return conn.get_all_domains()
+    """
+    :return: list. domain names
+    """
+    return backend.list_domains()
 
 
 def create_domain(domain):
-    return conn.create_domain(domain)
+    return backend.create_domain(domain)
 
+
+def delete_domain(domain):
+    """
+    Delete a domain with all its items
+    """
+    return backend.delete_domain(domain)
@@ -2,6 +2,8 @@ import settings
 import boto3
 import botocore.exceptions
 import logging
+import threading
+import time
 
 logger = logging.getLogger('ecs_id_mapper')
 
@@ -11,11 +13,34 @@ client = boto3.client('ecs',
                       region_name=settings.simpledb_aws_region
                       )
 
+# (cluster_name, service_name) -> (expiry time, list of task ids)
+_task_id_cache = {}
+# (cluster_name, service_name) -> _Flight of the list_tasks calls currently being made for that service
+_in_flight = {}
+_lock = threading.Lock()
 
-def get_task_ids_from_service(service_name, cluster_name):
+
+class _Flight(object):
+    """
+    Result of a task list lookup that concurrent callers for the same service wait on
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _list_task_ids(service_name, cluster_name):
     logger.info('Making call to AWS API for service {} and cluster {}'.format(service_name, cluster_name))
+    tasks = []
+    kwargs = {'cluster': cluster_name, 'serviceName': service_name}
     try:
-        tasks = client.list_tasks(cluster=cluster_name, serviceName=service_name)['taskArns']
+        while True:
+            response = client.list_tasks(**kwargs)
+            tasks.extend(response['taskArns'])
+            if not response.get('nextToken'):
+                break
+            kwargs['nextToken'] = response['nextToken']
     except botocore.exceptions.ClientError:
         logger.info('ECS service {} not found'.format(service_name))
         raise Exception('ECS service not found')
@@ -26,3 +51,38 @@ def get_task_ids_from_service(service_name, cluster_name):
             tlist.append(task.split('/')[1])
     return tlist
 
+
+def get_task_ids_from_service(service_name, cluster_name):
+    """
+    Get the ids of all tasks of an ECS service. Results are cached for settings.ecs_task_cache_ttl seconds and
+    concurrent lookups of the same service share a single set of ECS API calls.
+    :param service_name: str. Name of the service
+    :param cluster_name: str. Name of cluster service is in
+    :return: list. task ids
+    """
+    key = (cluster_name, service_name)
+    with _lock:
+        cached = _task_id_cache.get(key)
+        if cached and cached[0] > time.time():
+            return list(cached[1])
+        flight = _in_flight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _in_flight[key] = _Flight()
+    if not leader:
+        flight.done.wait()
+        if flight.error:
+            raise flight.error
+        return list(flight.result)
+    try:
+        flight.result = _list_task_ids(service_name, cluster_name)
+        with _lock:
+            _task_id_cache[key] = (time.time() + settings.ecs_task_cache_ttl, flight.result)
+        return list(flight.result)
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _lock:
+            del _in_flight[key]
+        flight.done.set()
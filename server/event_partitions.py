@@ -0,0 +1,95 @@
+"""
+Events are stored in one domain per day (or per hour with settings.event_partition = 'hour') named
+<events domain>_<YYYYMMDD> or <events domain>_<YYYYMMDDHH>, so queries over a time range only read the partitions
+that overlap it and old events are dropped a partition at a time.
+"""
+import calendar
+import threading
+import time
+import db
+import settings
+
+_FORMATS = {'day': ('%Y%m%d', 86400),
+            'hour': ('%Y%m%d%H', 3600)}
+
+# names of the existing domains, so queries don't make a ListDomains call each
+_domains_lock = threading.Lock()
+_domains = {'names': None, 'expiry': 0}
+
+
+def _format():
+    try:
+        return _FORMATS[settings.event_partition]
+    except KeyError:
+        raise Exception('Unknown event partition {}'.format(settings.event_partition))
+
+
+def partition_size():
+    """
+    :return: int. seconds covered by a partition
+    """
+    return _format()[1]
+
+
+def partition_for(timestamp):
+    """
+    :param timestamp: float. epoch time of an event
+    :return: str. name of the domain the event is stored in
+    """
+    return '{}_{}'.format(settings.events_schema, time.strftime(_format()[0], time.gmtime(float(timestamp))))
+
+
+def partition_start(domain):
+    """
+    :param domain: str. domain name
+    :return: int. epoch time the partition starts at, None if domain is not an event partition
+    """
+    prefix = settings.events_schema + '_'
+    if not domain.startswith(prefix):
+        return None
+    try:
+        return calendar.timegm(time.strptime(domain[len(prefix):], _format()[0]))
+    except ValueError:
+        return None
+
+
+def partitions_between(domains, start, end):
+    """
+    :param domains: list. names of existing domains
+    :param start: float. epoch time
+    :param end: float. epoch time
+    :return: list. names of the event partitions among domains that overlap [start, end], oldest first
+    """
+    size = partition_size()
+    partitions = []
+    for domain in domains:
+        partition_start_time = partition_start(domain)
+        if partition_start_time is not None and partition_start_time <= end and partition_start_time + size > start:
+            partitions.append((partition_start_time, domain))
+    return [domain for _, domain in sorted(partitions)]
+
+
+def known_domains():
+    """
+    :return: list. names of the existing domains, listed again every settings.event_partition_cache_ttl seconds
+    """
+    with _domains_lock:
+        if _domains['names'] is None or _domains['expiry'] <= time.time():
+            _domains['names'] = set(db.list_domains())
+            _domains['expiry'] = time.time() + settings.event_partition_cache_ttl
+        return list(_domains['names'])
+
+
+def partition_created(domain):
+    """
+    Add a partition written to by this process to the known domains
+    """
+    with _domains_lock:
+        if _domains['names'] is not None:
+            _domains['names'].add(domain)
+
+
+def partition_dropped(domain):
+    with _domains_lock:
+        if _domains['names'] is not None:
+            _domains['names'].discard(domain)
@@ -0,0 +1,55 @@
+import hashlib
+import json
+import logging
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger('ecs_id_mapper')
+
+MIMETYPES = {'msgpack': 'application/x-msgpack',
+             'json': 'application/x-ndjson'}
+
+
+def default_format():
+    return 'msgpack' if msgpack else 'json'
+
+
+def encode(rows, fmt):
+    """
+    Encode rows in a columnar layout: {"names": [item names], "columns": {attribute: [value of each row]}}.
+    Values are null where a row doesn't have the attribute.
+    :param rows: list. rows to encode
+    :param fmt: str. 'msgpack' or 'json'
+    :return: str. encoded rows, a json document ends with a newline
+    """
+    attributes = set()
+    for row in rows:
+        attributes.update(row.iterkeys())
+    snapshot = {'names': [row.name for row in rows],
+                'columns': dict((attribute, [row.get(attribute) for row in rows]) for attribute in attributes)}
+    if fmt == 'msgpack':
+        return msgpack.packb(snapshot)
+    return json.dumps(snapshot, separators=(',', ':')) + '\n'
+
+
+def etag(*parts):
+    """
+    :param parts: whatever the content of an export depends on, e.g. the change feed position and the filters
+    :return: str. ETag of the export
+    """
+    return hashlib.md5(json.dumps(parts)).hexdigest()
+
+
+def encode_pages(pages, fmt):
+    """
+    Generator over the encoded pages of an export, each page is encoded on its own so the export is streamed
+    as a sequence of msgpack objects or as lines of json
+    :param pages: iterable. lists of rows
+    :param fmt: str. 'msgpack' or 'json'
+    """
+    for rows in pages:
+        if rows:
+            yield encode(rows, fmt)
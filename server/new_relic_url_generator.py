@@ -4,6 +4,8 @@ import requests
 import logging
 import settings
 import ecs_api
+import threading
+from collections import OrderedDict
 
 logger = logging.getLogger('ecs_id_mapper')
 
@@ -13,6 +15,24 @@ logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 nr_api_key = settings.nr_api_key
 
+# New Relic hosts are docker short ids. Lookups are cached so the request path never has to call New Relic.
+_cache_lock = threading.Lock()
+_host_applications = {}  # host -> (expiry, application id)
+_instance_urls = {}  # (application id, host) -> (expiry, app instance url)
+_misses = {}  # host -> expiry. hosts New Relic didn't know about
+
+# index of the hosts of every New Relic application, built from bulk listings by refresh_index()
+_index_lock = threading.Lock()
+_app_hosts = {}  # application id -> dict of New Relic host id -> (host, app instance url or None)
+_host_index = {}  # host -> app instance url
+_index_state = {'refreshed': 0, 'ok': False}
+# host ids per request when listing hosts by id, keeps the query string short
+_HOST_IDS_PER_REQUEST = 50
+
+# map entries waiting for the background resolver, item name -> container id
+_pending = OrderedDict()
+_pending_cond = threading.Condition()
+
 
 class NewRelicAPIException(Exception):
     '''
@@ -20,48 +40,168 @@ class NewRelicAPIException(Exception):
     '''
 
 
+def _cache_get(cache, key):
+    entry = cache.get(key)
+    if entry and entry[0] > time.time():
+        return entry[1]
+    return None
+
+
+def _list_pages(url, key):
+    """
+    Generator over every item of a paginated New Relic API listing
+    :param url: str. URL of the first page
+    :param key: str. key of the list of items in the response
+    """
+    while url:
+        r = requests.get(url, headers={"X-Api-Key": nr_api_key}, timeout=settings.nr_index_timeout)
+        r.raise_for_status()
+        for item in r.json()[key]:
+            yield item
+        url = r.links.get('next', {}).get('url')
+
+
+def refresh_index():
+    """
+    Bring the host index up to date. The application listing carries the ids of each application's hosts
+    (links.application_hosts), only hosts whose id we haven't seen are listed, by id. Hosts that are gone and
+    applications that stopped reporting are dropped.
+    """
+    start = time.time()
+    listed = 0
+    seen = set()
+    for app in _list_pages('https://api.newrelic.com/v2/applications.json', 'applications'):
+        application_id = app['id']
+        seen.add(application_id)
+        host_ids = set(app.get('links', {}).get('application_hosts', ())) if app.get('reporting') else set()
+        known = _app_hosts.get(application_id)
+        if known is not None and host_ids == set(known):
+            continue
+        known = known or {}
+        hosts = dict((host_id, known[host_id]) for host_id in host_ids & set(known))
+        new_host_ids = sorted(host_ids - set(known))
+        for i in range(0, len(new_host_ids), _HOST_IDS_PER_REQUEST):
+            chunk = new_host_ids[i:i + _HOST_IDS_PER_REQUEST]
+            listed += 1
+            # hosts New Relic doesn't return are remembered without a URL so they aren't listed on every refresh
+            hosts.update((host_id, (None, None)) for host_id in chunk)
+            for app_host in _list_pages('https://api.newrelic.com/v2/applications/{}/hosts.json?filter[ids]={}'.format(
+                    application_id, ','.join(str(host_id) for host_id in chunk)), 'application_hosts'):
+                try:
+                    hosts[app_host['id']] = (app_host['host'], settings.new_relic_app_instance_url.format(
+                        account_id=settings.new_relic_account_id,
+                        application_id=application_id,
+                        application_instance_id=app_host['links']['application_instances'][0]))
+                except (KeyError, IndexError):
+                    continue
+        with _index_lock:
+            _set_app_hosts(application_id, hosts)
+    with _index_lock:
+        for application_id in set(_app_hosts) - seen:
+            _set_app_hosts(application_id, {})
+            del _app_hosts[application_id]
+        _index_state['refreshed'] = time.time()
+        _index_state['ok'] = True
+        logger.info('Refreshed New Relic index in {:.1f}s. Made {} host listing requests, {} hosts known'.format(
+            time.time() - start, listed, len(_host_index)))
+
+
+def _set_app_hosts(application_id, hosts):
+    """
+    Replace the hosts of an application in the index. Called with _index_lock held.
+    :param hosts: dict. New Relic host id -> (host, app instance url or None)
+    """
+    for host, url in _app_hosts.get(application_id, {}).itervalues():
+        _host_index.pop(host, None)
+    _app_hosts[application_id] = hosts
+    _host_index.update((host, url) for host, url in hosts.itervalues() if url)
+
+
+def _index_enabled():
+    return settings.nr_index == 'true'
+
+
+def _index_complete():
+    """
+    :return: bool. True if the last index refresh succeeded, so a host missing from the index is unknown to New Relic
+    """
+    return _index_enabled() and _index_state['ok']
+
+
+def index_stats():
+    with _index_lock:
+        return {'applications': len(_app_hosts),
+                'hosts': len(_host_index),
+                'age': time.time() - _index_state['refreshed'] if _index_state['refreshed'] else None,
+                'complete': _index_state['ok']}
+
+
 def get_map_entries(timerange=30):
-    query = "select * from `ecs_id_mapper_hash` where `newrelic_url` is null and `sample_time` between '{}' and '{}'".\
-        format(time.time() - timerange, time.time())
-    result = db.search_domain(query, 'ecs_id_mapper_hash')
-    return result
+    """
+    :param timerange: int. seconds
+    :return: list. running map entries sampled in the last timerange seconds that don't have a New Relic URL
+    """
+    now = time.time()
+    return [result for result in db.find_by_sample_time(now - timerange, now, settings.hash_schema)
+            if 'new_relic_url' not in result and result.get('desired_status') == 'RUNNING']
 
 
-def update_nr_URL():
-    for result in get_map_entries():
-        nr_url = get_new_relic_app_instance_url(result['container_id'])
-        _result = result
-        _result['newrelic_url'] = nr_url
-        if len(nr_url) > 0 and nr_url is not 'unknown':
-            logger.info('Updating record with New Relic URL')
-            print(result.name, _result, 'ecs_id_mapper_hash')
-            db.put(result.name, _result, 'ecs_id_mapper_hash')
-        else:
-            logger.info('New Relic URL not found')
+def get_cached_app_instance_url(container_id):
+    """
+    Look up the New Relic app instance URL of a container in the local caches only
+    :param container_id: str.
+    :return: str. URL, None if we don't know yet
+    :raises NewRelicAPIException: if New Relic recently told us it doesn't know the container
+    """
+    host = container_id[:12]
+    if _index_enabled():
+        with _index_lock:
+            url = _host_index.get(host)
+        if url:
+            return url
+    with _cache_lock:
+        if _misses.get(host, 0) > time.time():
+            raise NewRelicAPIException
+        application_id = _cache_get(_host_applications, host)
+        if application_id is None:
+            return None
+        return _cache_get(_instance_urls, (application_id, host))
+
+
+def _remember_miss(container_id):
+    with _cache_lock:
+        _misses[container_id[:12]] = time.time() + settings.nr_negative_ttl
 
 
 def get_new_relic_app_instance_url(container_id):
     """
     Query New Relic API for list of applications filtered by host id (docker short id). If the application was found
-    key 'applications' will contain a list with details about the New Relic application.
+    key 'applications' will contain a list with details about the New Relic application. Results, including
+    misses, are cached.
     :param container_id:
     :return:
     """
     container_id = container_id[:12]  # Slice container id to shortened form
     # NR hostnames will always be in this format
     logger.info('Making request to New Relic API for container id {}'.format(container_id))
+    r = None
     try:
-        r = requests.get('https://api.newrelic.com/v2/applications.json?filter[host]={}'.format(container_id),
-                         headers={"X-Api-Key": nr_api_key,
-                                  "content-type": "application/x-www-form-urlencoded"},
-                         timeout=1)
-        logger.debug(r.text)
-        if len(r.json()['applications']) > 1:
-            # we got more applications back than we expected
-            logger.info('found more than one new relic application for that container')
-            raise NewRelicAPIException
+        with _cache_lock:
+            application_id = _cache_get(_host_applications, container_id)
+        if application_id is None:
+            r = requests.get('https://api.newrelic.com/v2/applications.json?filter[host]={}'.format(container_id),
+                             headers={"X-Api-Key": nr_api_key,
+                                      "content-type": "application/x-www-form-urlencoded"},
+                             timeout=1)
+            logger.debug(r.text)
+            if len(r.json()['applications']) > 1:
+                # we got more applications back than we expected
+                logger.info('found more than one new relic application for that container')
+                raise NewRelicAPIException
 
-        application_id = r.json()['applications'][0]['id']
+            application_id = r.json()['applications'][0]['id']
+            with _cache_lock:
+                _host_applications[container_id] = (time.time() + settings.nr_positive_ttl, application_id)
         r = requests.get('https://api.newrelic.com/v2/applications/{}/hosts.json?filter[hostname]={}'.format(
             application_id, container_id),
                          headers={"X-Api-Key": nr_api_key,
@@ -69,22 +209,102 @@ def get_new_relic_app_instance_url(container_id):
                          timeout=1)
         logger.debug(r.text)
         application_instance_id = r.json()['application_hosts'][0]['links']['application_instances'][0]
-        return settings.new_relic_app_instance_url.format(account_id=settings.new_relic_account_id,
-                                                          application_id=application_id,
-                                                          application_instance_id=application_instance_id)
+        url = settings.new_relic_app_instance_url.format(account_id=settings.new_relic_account_id,
+                                                         application_id=application_id,
+                                                         application_instance_id=application_instance_id)
+        with _cache_lock:
+            _instance_urls[(application_id, container_id)] = (time.time() + settings.nr_positive_ttl, url)
+        return url
     except requests.exceptions.Timeout:
         logger.info("New Relic didn't respond in time")
         raise NewRelicAPIException
-    except (IndexError, KeyError):
+    except (IndexError, KeyError, NewRelicAPIException):
         logger.info("Received an invalid response from New Relic. Likely this container ID wasn't found")
         if r:
             logger.debug(r.json())
+        _remember_miss(container_id)
         raise NewRelicAPIException
     except requests.exceptions.SSLError as e:
         logger.error("SSL error connecting to New Relic {}".format(e))
         raise NewRelicAPIException
 
 
+def queue_container(item_name, container_id):
+    """
+    Queue a map entry for the background resolver to look up its New Relic URL
+    :param item_name: str. name of the map entry in the hash domain
+    :param container_id: str.
+    """
+    with _pending_cond:
+        _pending[item_name] = container_id
+        if len(_pending) >= settings.nr_resolver_batch_size:
+            _pending_cond.notify()
+
+
+def resolve_pending():
+    """
+    Look up New Relic URLs of queued map entries and store the ones found in one batch
+    """
+    with _pending_cond:
+        batch = []
+        while _pending and len(batch) < settings.nr_resolver_batch_size:
+            batch.append(_pending.popitem(last=False))
+    resolved = {}
+    for item_name, container_id in batch:
+        try:
+            url = get_cached_app_instance_url(container_id)
+            if url is None and _index_complete():
+                # the index has every host New Relic knows about, no need to ask about this one
+                _remember_miss(container_id)
+                continue
+            url = url or get_new_relic_app_instance_url(container_id)
+        except NewRelicAPIException:
+            continue
+        except requests.exceptions.RequestException as e:
+            logger.error('Error calling New Relic API: {}'.format(e))
+            _remember_miss(container_id)
+            continue
+        resolved[item_name] = {'new_relic_url': url}
+    if resolved:
+        logger.info('Storing {} New Relic URLs'.format(len(resolved)))
+        db.batch_put(resolved, settings.hash_schema)
+
+
+def _resolver_loop():
+    last_sweep = 0
+    while True:
+        with _pending_cond:
+            if len(_pending) < settings.nr_resolver_batch_size:
+                _pending_cond.wait(settings.nr_resolver_interval)
+        try:
+            if _index_enabled() and time.time() - _index_state['refreshed'] >= settings.nr_index_interval:
+                try:
+                    refresh_index()
+                except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                    logger.error('Unable to refresh New Relic index: {}'.format(e))
+                    _index_state['refreshed'] = time.time()  # try again next interval
+                    _index_state['ok'] = False
+            if time.time() - last_sweep >= settings.nr_resolver_interval:
+                # pick up entries reported to other servers or that New Relic didn't know about yet
+                last_sweep = time.time()
+                for result in get_map_entries(settings.nr_sweep_window):
+                    if 'container_id' in result:
+                        queue_container(result.name, result['container_id'])
+            while _pending:
+                resolve_pending()
+        except Exception:
+            logger.exception('Error resolving New Relic URLs')
+
+
+def start_resolver():
+    """
+    Start the background thread that resolves New Relic URLs of new map entries
+    """
+    resolver = threading.Thread(target=_resolver_loop, name='new_relic_resolver')
+    resolver.daemon = True
+    resolver.start()
+
+
 def get_new_relic_service_url(service_name, cluster_name):
     """
     Get the new relic application URL for a given service. Assumes any one of the tasks in service report to the same
@@ -100,9 +320,8 @@ def get_new_relic_service_url(service_name, cluster_name):
     else:
         task_id = task_id[0]  # take the first task ID we found since we only need one
     logger.info('Found task_id {} for service {}'.format(task_id, service_name))
-    resultset = db.search_domain(
-                'select * from `ecs_id_mapper_hash` where task_id="{task_id}" and desired_status="RUNNING"'.
-                format(task_id=task_id), 'ecs_id_mapper_hash')
+    resultset = (result for result in db.find_by_task_id(task_id, settings.hash_schema)
+                 if result.get('desired_status') == 'RUNNING')
     try:
         r = resultset.next()
         new_relic_url = r['new_relic_url']
@@ -110,6 +329,8 @@ def get_new_relic_service_url(service_name, cluster_name):
         logger.info('Unable to find task {} details in our database'.format(task_id))
         raise NewRelicAPIException
     except KeyError:
-        new_relic_url = get_new_relic_app_instance_url(r['container_id'])
-        db.put(r.name, {"new_relic_url": new_relic_url}, settings.hash_schema, replace=True)
+        new_relic_url = get_cached_app_instance_url(r['container_id'])
+        if new_relic_url is None:
+            queue_container(r.name, r['container_id'])
+            raise NewRelicAPIException
     return new_relic_url.split('_')[0]
@@ -0,0 +1,98 @@
+import threading
+
+
+class AmbiguousPrefixError(Exception):
+    '''
+    More than one known container id starts with the given prefix
+    '''
+    def __init__(self, prefix, count):
+        super(AmbiguousPrefixError, self).__init__(
+            'Container id prefix {} matches {} containers'.format(prefix, count))
+        self.prefix = prefix
+        self.count = count
+
+
+class _Node(object):
+    __slots__ = ('count', 'children', 'ids')
+
+    def __init__(self):
+        self.count = 0
+        self.children = {}
+        self.ids = None
+
+
+class PrefixIndex(object):
+    """
+    Trie over the first `depth` characters of every known container id. Each node counts the container ids
+    below it, so resolving a prefix is a walk of len(prefix) nodes. Full ids are kept in the nodes at
+    `depth`, which bounds the trie to `depth` nodes per container.
+    """
+    def __init__(self, depth=12):
+        self.depth = depth
+        self._root = _Node()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._root.count
+
+    def _walk(self, prefix):
+        node = self._root
+        for char in prefix[:self.depth]:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+
+    def add(self, container_id):
+        """
+        :param container_id: str. full container id
+        :return: bool. True if the id was not already known
+        """
+        with self._lock:
+            leaf = self._walk(container_id)
+            if leaf is not None and leaf.ids and container_id in leaf.ids:
+                return False
+            node = self._root
+            node.count += 1
+            for char in container_id[:self.depth]:
+                node = node.children.setdefault(char, _Node())
+                node.count += 1
+            if node.ids is None:
+                node.ids = set()
+            node.ids.add(container_id)
+            return True
+
+    def remove(self, container_id):
+        with self._lock:
+            leaf = self._walk(container_id)
+            if leaf is None or not leaf.ids or container_id not in leaf.ids:
+                return False
+            leaf.ids.discard(container_id)
+            node = self._root
+            node.count -= 1
+            for char in container_id[:self.depth]:
+                child = node.children[char]
+                child.count -= 1
+                if child.count == 0:
+                    del node.children[char]
+                    break
+                node = child
+            return True
+
+    def resolve(self, prefix):
+        """
+        Find the full container id a short id refers to
+        :param prefix: str. container id prefix, at most `depth` characters
+        :return: str. the full container id, None if no known container matches
+        :raises AmbiguousPrefixError: if more than one known container matches
+        """
+        with self._lock:
+            node = self._walk(prefix)
+            if node is None or node.count == 0:
+                return None
+            if node.count > 1:
+                raise AmbiguousPrefixError(prefix, node.count)
+            # exactly one id below this node, follow the only branch down to it
+            while node.children:
+                node = next(iter(node.children.values()))
+            return next(iter(node.ids))
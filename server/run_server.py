@@ -1,7 +1,8 @@
 from tornado.wsgi import WSGIContainer
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
-from server import ecs_id_mapper
+from tornado.netutil import bind_sockets
+from tornado import process
 import logging
 import settings
 
@@ -21,6 +22,24 @@ logging.getLogger("urllib3").setLevel(logging.WARNING)
 logging.getLogger('tornado').addHandler(stderr_logs)
 
 logger.info('Starting server on port {}'.format(str(settings.server_port)))
-http_server = HTTPServer(WSGIContainer(ecs_id_mapper))
-http_server.listen(settings.server_port)
-IOLoop.instance().start()
+sockets = bind_sockets(int(settings.server_port))
+if settings.server_processes != 1:
+    # fork before the app is imported so every process starts its own background threads
+    process.fork_processes(settings.server_processes)
+    if process.task_id() is not None:
+        settings.write_behind_spool = '{}.{}'.format(settings.write_behind_spool, process.task_id())
+        if process.task_id() != 0:
+            # one compactor per server is enough
+            settings.compactor = 'false'
+
+from server import ecs_id_mapper
+
+if settings.server_threads > 0:
+    from threaded_wsgi import ThreadedWSGIContainer
+    logger.info('Handling requests on {} threads'.format(settings.server_threads))
+    container = ThreadedWSGIContainer(ecs_id_mapper, settings.server_threads)
+else:
+    container = WSGIContainer(ecs_id_mapper)
+http_server = HTTPServer(container)
+http_server.add_sockets(sockets)
+IOLoop.current().start()
@@ -0,0 +1,293 @@
+import boto.sdb
+from boto.exception import SDBResponseError
+from multiprocessing.pool import ThreadPool
+import threading
+import random
+import time
+import settings
+import logging
+
+logger = logging.getLogger('ecs_id_mapper')
+
+
+def _connect():
+    return boto.sdb.connect_to_region(settings.simpledb_aws_region,
+                                      aws_access_key_id=settings.aws_id,
+                                      aws_secret_access_key=settings.aws_secret_key)
+
+# boto connections and the domain objects bound to them are not thread safe, every thread (request threads, batch
+# writer threads) gets its own connection, made on first use, and its own domain objects
+_thread_state = threading.local()
+# bumped when a domain is deleted so threads drop the domain objects they cached
+_domains_state = {'generation': 0}
+_write_pool = {}
+_write_pool_lock = threading.Lock()
+
+
+def _get_conn():
+    try:
+        return _thread_state.conn
+    except AttributeError:
+        _thread_state.conn = _connect()
+        return _thread_state.conn
+
+
+def _thread_domains():
+    """
+    :return: dict. domain name -> domain object of the calling thread
+    """
+    if getattr(_thread_state, 'generation', None) != _domains_state['generation']:
+        _thread_state.domains = {}
+        _thread_state.generation = _domains_state['generation']
+    return _thread_state.domains
+
+
+def _quote(value):
+    """
+    :param value: str. value to compare against in a select expression
+    :return: str. value as a quoted SimpleDB string literal
+    """
+    return '"{}"'.format(str(value).replace('"', '""'))
+
+
+def _get_domain(domain):
+    """
+    Check if I have the domain object in local state, if not create one, and if the domain does
+    not exist, make a create_domain call and return the domain obj.
+    :param domain: str. name of the domain to get
+    :return: domain obj.
+    """
+    assert type(domain) == str
+    conn = _get_conn()
+    domains = _thread_domains()
+    try:
+        _dom = domains[domain]
+    except KeyError:
+        try:
+            _dom = conn.get_domain(domain)
+            domains[domain] = _dom
+        except SDBResponseError as e:
+            if str(e.error_code) == 'NoSuchDomain':
+                logger.info('Domain {dom} does not exist, creating...'.format(dom=domain))
+                # The domain doesn't exist
+                # create the domain
+                conn.create_domain(domain)
+                # get the domain object
+                _dom = conn.get_domain(domain)
+                # store domain obj for later use
+                domains[domain] = _dom
+            else:
+                # something else happened that we don't know how to handle
+                raise
+    # finally, return domain
+    return _dom
+
+
+def _batch_items(items, increment=25):
+    """
+    generator that returns a dictionary of a specified size of keys
+    :param items: dict. dictionary to batch
+    :param increment: int. qty of keys per batch
+    :return: dict. batched results
+    """
+    assert type(items) == dict
+    assert type(increment) == int
+    r = {}
+    for k,v in items.iteritems():
+        r[k] = v
+        if len(r) == increment:
+            yield r
+            r = {}
+    if len(r) > 0:
+        yield r
+
+
+def _get_write_pool():
+    with _write_pool_lock:
+        if 'pool' not in _write_pool:
+            _write_pool['pool'] = ThreadPool(settings.sdb_write_threads)
+        return _write_pool['pool']
+
+
+def _call_throttled(operation, domain, items):
+    """
+    Call a batch operation from a writer thread, retrying with backoff while SimpleDB throttles us
+    :param operation: str. name of the boto connection method, e.g. 'batch_put_attributes'
+    :param domain: str. domain name
+    :param items: dict. argument of the batch operation
+    """
+    thread_conn = _get_conn()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return getattr(thread_conn, operation)(domain, items)
+        except SDBResponseError as e:
+            if e.status != 503 or attempt >= settings.sdb_max_attempts:
+                raise
+            backoff_time = random.uniform(0, 0.1 * 2 ** attempt)
+            logger.info('SimpleDB throttled {} on {}. Retrying in {:.2f} seconds'.format(operation, domain,
+                                                                                      backoff_time))
+            time.sleep(backoff_time)
+
+
+def _put_batch(args):
+    """
+    :param args: tuple. (domain name, dict of items)
+    """
+    domain, items = args
+    return _call_throttled('batch_put_attributes', domain, items)
+
+
+def _delete_batch(args):
+    """
+    :param args: tuple. (domain name, dict of item names -> None)
+    """
+    domain, items = args
+    return _call_throttled('batch_delete_attributes', domain, items)
+
+
+def batch_put(items, domain):
+    """
+    Write items in batches of 25 (the SimpleDB limit), dispatched concurrently to the writer pool
+    :param items: dict. item name -> attributes
+    :param domain: str. name of the domain to write to
+    :return: bool.
+    """
+    _get_domain(domain)  # make sure the domain exists
+    _get_write_pool().map(_put_batch, [(domain, batch) for batch in _batch_items(items)])
+    return True
+
+
+def batch_delete(keys, domain):
+    """
+    Delete items in batches of 25, dispatched concurrently to the writer pool
+    :param keys: list. names of the items to delete
+    :param domain: str. name of the domain to delete from
+    :return: bool.
+    """
+    _get_domain(domain)
+    items = dict((key, None) for key in keys)
+    _get_write_pool().map(_delete_batch, [(domain, batch) for batch in _batch_items(items)])
+    return True
+
+
+def get(key, domain, consistent_read=True):
+    dom = _get_domain(domain)
+    return dom.get_item(key, consistent_read=consistent_read)
+
+
+def get_all_dom(domain):
+    dom = _get_domain(domain)
+    return dom.select('select * from `{dom}`'.format(dom=domain))
+
+
+def _select(query, domain):
+    dom = _get_domain(domain)
+    return dom.select(query)
+
+
+def del_key(key, domain):
+    dom = _get_domain(domain)
+    return dom.delete_item(get(key, domain))
+
+
+def find_by_container_id(container_id, domain):
+    return _select('select * from `{dom}` where container_id={v}'.format(
+        dom=domain, v=_quote(container_id)), domain)
+
+
+def find_by_container_prefix(prefix, domain):
+    return _select('select * from `{dom}` where container_id like {v}'.format(
+        dom=domain, v=_quote(prefix + '%')), domain)
+
+
+def find_by_task_id(task_id, domain):
+    return _select('select * from `{dom}` where task_id={v}'.format(dom=domain, v=_quote(task_id)), domain)
+
+
+def _find_in(attribute, values, domain):
+    """
+    select items whose attribute is one of values with `in (...)` selects of up to settings.sdb_max_in_values
+    values each
+    """
+    values = list(values)
+    for i in range(0, len(values), settings.sdb_max_in_values):
+        chunk = values[i:i + settings.sdb_max_in_values]
+        for item in _select('select * from `{dom}` where {a} in ({v})'.format(
+                dom=domain, a=attribute, v=','.join(_quote(v) for v in chunk)), domain):
+            yield item
+
+
+def find_by_container_ids(container_ids, domain):
+    return _find_in('container_id', container_ids, domain)
+
+
+def find_by_task_ids(task_ids, domain):
+    return _find_in('task_id', task_ids, domain)
+
+
+def find_by_task_name(task_name, domain):
+    return _select('select * from `{dom}` where task_name={v}'.format(dom=domain, v=_quote(task_name)), domain)
+
+
+def find_by_sample_time(start, end, domain, desired_status=None):
+    where = 'sample_time between {s} and {e}'.format(s=_quote(start), e=_quote(end))
+    if desired_status is not None:
+        where += ' and desired_status={}'.format(_quote(desired_status))
+    return _select('select * from `{dom}` where {w}'.format(dom=domain, w=where), domain)
+
+
+def find_page(attribute, values, domain, limit, cursor=None):
+    if attribute == 'container_prefix':
+        where = ' or '.join('container_id like {}'.format(_quote(v + '%')) for v in values)
+    else:
+        where = '{} in ({})'.format(attribute, ','.join(_quote(v) for v in values))
+    # a single Select call returns one page, its next_token is the cursor of the next one
+    results = _get_conn().select(_get_domain(domain), 'select * from `{dom}` where {w} limit {l}'.format(
+        dom=domain, w=where, l=int(limit)), next_token=cursor)
+    return list(results), getattr(results, 'next_token', None)
+
+
+def select_page(domain, limit, cursor=None, cluster_name=None, desired_status=None):
+    conditions = ['{}={}'.format(attribute, _quote(value))
+                  for attribute, value in (('cluster_name', cluster_name), ('desired_status', desired_status))
+                  if value is not None]
+    where = ' where ' + ' and '.join(conditions) if conditions else ''
+    results = _get_conn().select(_get_domain(domain), 'select * from `{dom}`{w} limit {l}'.format(
+        dom=domain, w=where, l=int(limit)), next_token=cursor)
+    return list(results), getattr(results, 'next_token', None)
+
+
+def find_by_timestamp(start, end, domain):
+    return _select('select * from `{dom}` where timestamp between {s} and {e}'.format(
+        dom=domain, s=_quote(start), e=_quote(end)), domain)
+
+
+def all_container_ids(domain):
+    for item in _select('select container_id from `{dom}`'.format(dom=domain), domain):
+        if 'container_id' in item:
+            yield item['container_id']
+
+
+def find_events(attribute, value, start, end, domain, limit, cursor=None):
+    # order by needs the attribute in the where clause, timestamps are compared as strings like every value
+    results = _get_conn().select(_get_domain(domain), 'select * from `{dom}` where {a}={v} and timestamp between {s} '
+                                 'and {e} order by timestamp limit {l}'.format(
+                                     dom=domain, a=attribute, v=_quote(value), s=_quote(start), e=_quote(end),
+                                     l=int(limit)), next_token=cursor)
+    return list(results), getattr(results, 'next_token', None)
+
+
+def list_domains():
+    return [dom.name for dom in _get_conn().get_all_domains()]
+
+
+def create_domain(domain):
+    return _get_conn().create_domain(domain)
+
+
+def delete_domain(domain):
+    _domains_state['generation'] += 1
+    return _get_conn().delete_domain(domain)
+
@@ -1,16 +1,433 @@
-from flask import Flask, request, redirect, jsonify, abort
-from werkzeug.exceptions import NotFound
+from flask import Flask, Response, request, redirect, jsonify, abort
 import db
 import logging
 import copy
 import settings
 import new_relic_url_generator
 import ecs_api
+import cache
+import prefix_index
+import write_behind
+import export
+import change_feed
+import compactor
+import event_partitions
+import time
+import threading
+import zlib
+import json
+import base64
+from io import BytesIO
 
 ecs_id_mapper = Flask(__name__)
 logger = logging.getLogger('ecs_id_mapper')
 
 
+class GzipRequestMiddleware(object):
+    """
+    WSGI middleware that transparently inflates request bodies sent with Content-Encoding: gzip
+    """
+    def __init__(self, app, max_size):
+        self.app = app
+        self.max_size = max_size
+
+    def __call__(self, environ, start_response):
+        if environ.get('HTTP_CONTENT_ENCODING', '').lower() == 'gzip':
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                body = inflater.decompress(environ['wsgi.input'].read(length), self.max_size)
+            except zlib.error:
+                start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+                return ['invalid gzip request body']
+            if inflater.unconsumed_tail:
+                start_response('413 Request Entity Too Large', [('Content-Type', 'text/plain')])
+                return ['request body too large']
+            environ['wsgi.input'] = BytesIO(body)
+            environ['CONTENT_LENGTH'] = str(len(body))
+            del environ['HTTP_CONTENT_ENCODING']
+        return self.app(environ, start_response)
+
+ecs_id_mapper.wsgi_app = GzipRequestMiddleware(ecs_id_mapper.wsgi_app, settings.max_request_size)
+
+map_cache = cache.MapCache(max_entries=settings.cache_max_entries, ttl=settings.cache_ttl)
+container_ids = prefix_index.PrefixIndex()
+prefix_index_state = {'warm': False}
+changes = change_feed.ChangeFeed(settings.change_feed_size, max_subscribers=settings.change_feed_max_subscribers)
+write_buffer = None
+if settings.write_behind == 'true':
+    write_buffer = write_behind.WriteBehindBuffer(db.batch_put, settings.write_behind_spool,
+                                                  flush_interval=settings.write_behind_flush_interval,
+                                                  fsync=settings.write_behind_fsync == 'true')
+
+
+def _write(items, domain):
+    """
+    write items to the DB, or to the write-behind buffer if it is enabled
+    :param items: dict. item name -> attributes
+    :param domain: str. name of the domain to write to
+    """
+    if write_buffer:
+        write_buffer.put_many(items, domain)
+    else:
+        db.batch_put(items, domain)
+
+
+def _pending_rows(match):
+    """
+    :param match: function. called with the attributes of a row, True if the lookup wants it
+    :return: dict. item name -> attributes of the matching rows still in the write-behind buffer
+    """
+    if not write_buffer:
+        return {}
+    return write_buffer.find(settings.hash_schema, match)
+
+
+def _with_pending(rows, pending):
+    """
+    :param rows: list. rows read from the DB
+    :param pending: dict. item name -> attributes of rows of the same lookup still in the write-behind buffer
+    :return: list. rows with the buffered writes applied, and the buffered rows the DB doesn't have yet added
+    """
+    if not pending:
+        return rows
+    pending = dict(pending)
+    merged = []
+    for row in rows:
+        if row.name in pending:
+            attrs = dict(row)
+            attrs.update(pending.pop(row.name))
+            row = cache.CachedItem(row.name, attrs)
+        merged.append(row)
+    merged.extend(cache.CachedItem(name, attrs) for name, attrs in pending.iteritems())
+    return merged
+
+
+def _cache_enabled():
+    return settings.cache_enabled == 'true'
+
+
+def _cache_rows(rows, container_id=None, task_id=None):
+    """
+    :param rows: list. rows read from the hash domain
+    :param container_id: str. container rows holds every row of, so lookups of it can be answered from the cache
+    :param task_id: str. task rows holds every row of
+    """
+    for row in rows:
+        if 'container_id' in row:
+            container_ids.add(row['container_id'])
+    if not _cache_enabled():
+        return
+    if container_id:
+        map_cache.put_container_rows(container_id, rows)
+    elif task_id:
+        map_cache.put_task_rows(task_id, rows)
+    else:
+        for row in rows:
+            map_cache.put(row.name, row)
+
+
+def _warm_prefix_index():
+    """
+    Load every container id we have stored into the prefix index
+    """
+    logger.info('Loading container ids into prefix index')
+    try:
+        for container_id in db.all_container_ids(settings.hash_schema):
+            container_ids.add(container_id)
+    except Exception as e:
+        logger.error('Unable to load container ids into prefix index: {}'.format(e))
+        return
+    prefix_index_state['warm'] = True
+    logger.info('Prefix index loaded with {} container ids'.format(len(container_ids)))
+
+
+def _prefix_index_complete():
+    """
+    :return: bool. True if the prefix index holds every container id, so a short id it doesn't know is not stored.
+     Only a server that receives every map report can know that, settings.prefix_index_authoritative says so.
+    """
+    return prefix_index_state['warm'] and settings.prefix_index_authoritative == 'true'
+
+
+def _resolve_container_id(container_id):
+    """
+    :param container_id: str. full container id, or a short (12 chars or fewer) prefix of one
+    :return: str. the full container id if the prefix index knows it, otherwise container_id as it was passed
+    """
+    if len(container_id) <= 12:
+        try:
+            full_container_id = container_ids.resolve(container_id)
+        except prefix_index.AmbiguousPrefixError as e:
+            logger.info(str(e))
+            abort(409, str(e))
+        if full_container_id:
+            return full_container_id
+    return container_id
+
+
+def _forget_rows(rows):
+    """
+    drop deleted rows from the cache, and their containers from the prefix index once none of their rows are left
+    :param rows: list. rows deleted from the hash domain
+    """
+    for row in rows:
+        map_cache.invalidate(row.name)
+    changes.publish([{'type': 'removed', 'name': row.name} for row in rows])
+    for container_id in set(row['container_id'] for row in rows if 'container_id' in row):
+        if not list(db.find_by_container_id(container_id, settings.hash_schema)):
+            container_ids.remove(container_id)
+
+
+def _query_container_id(container_id):
+    """
+    find all rows in the hash domain for a container, serving from the cache where possible
+    :param container_id: str. full container id, or a short (12 chars or fewer) prefix of one
+    :return: list. matching rows
+    """
+    container_id = _resolve_container_id(container_id)
+    if _cache_enabled():
+        rows = map_cache.get_by_container_id(container_id)
+        if rows:
+            return rows
+    if len(container_id) <= 12:
+        rows = list(db.find_by_container_prefix(container_id, settings.hash_schema))
+        pending = _pending_rows(lambda attrs: attrs.get('container_id', '').startswith(container_id))
+    else:
+        rows = list(db.find_by_container_id(container_id, settings.hash_schema))
+        pending = _pending_rows(lambda attrs: attrs.get('container_id') == container_id)
+    rows = _with_pending(rows, pending)
+    _cache_rows(rows, container_id=container_id)
+    return rows
+
+
+def _query_task_id(task_id):
+    """
+    find all rows in the hash domain for a task, serving from the cache where possible
+    :param task_id: str. Task id is a uuid like string generated by ECS for each instance of a task
+    :return: list. matching rows
+    """
+    if _cache_enabled():
+        rows = map_cache.get_by_task_id(task_id)
+        if rows:
+            return rows
+    rows = list(db.find_by_task_id(task_id, settings.hash_schema))
+    rows = _with_pending(rows, _pending_rows(lambda attrs: attrs.get('task_id') == task_id))
+    _cache_rows(rows, task_id=task_id)
+    return rows
+
+
+def _query_container_ids(requested_ids):
+    """
+    find all rows in the hash domain for a set of containers. Short ids are resolved through the prefix index,
+    containers not in the cache are fetched from the DB in batched lookups
+    :param requested_ids: list. full container ids and short (12 chars or fewer) prefixes of them
+    :return: tuple. (dict requested id -> list of matching rows, list of short ids matching more than one container)
+    """
+    results = dict((requested, []) for requested in requested_ids)
+    ambiguous = []
+    missing = {}  # full container id -> requested ids
+    prefixes = []
+    for requested in results.keys():
+        container_id = requested
+        if len(requested) <= 12:
+            try:
+                container_id = container_ids.resolve(requested) or requested
+            except prefix_index.AmbiguousPrefixError:
+                ambiguous.append(requested)
+                del results[requested]
+                continue
+        rows = map_cache.get_by_container_id(container_id) if _cache_enabled() else []
+        if rows:
+            results[requested] = rows
+        elif len(container_id) <= 12:
+            prefixes.append(container_id)
+        else:
+            missing.setdefault(container_id, []).append(requested)
+    if len(missing) > 0:
+        rows_by_container = dict((container_id, []) for container_id in missing)
+        for row in db.find_by_container_ids(missing.keys(), settings.hash_schema):
+            rows_by_container[row['container_id']].append(row)
+        pending_by_container = dict((container_id, {}) for container_id in missing)
+        for name, attrs in _pending_rows(lambda attrs: attrs.get('container_id') in missing).iteritems():
+            pending_by_container[attrs['container_id']][name] = attrs
+        for container_id, rows in rows_by_container.iteritems():
+            rows = _with_pending(rows, pending_by_container[container_id])
+            _cache_rows(rows, container_id=container_id)
+            for requested in missing[container_id]:
+                results[requested] = rows
+    if len(prefixes) > 0 and not _prefix_index_complete():
+        # short ids the prefix index doesn't know, e.g. before it is warm. Looked up settings.sdb_max_in_values
+        # prefixes per select rather than one scan each
+        rows_by_prefix = dict((prefix, []) for prefix in prefixes)
+        for rows, _ in _row_pages('container_prefix', prefixes, settings.sdb_max_select_limit):
+            for row in rows:
+                for prefix in prefixes:
+                    if row['container_id'].startswith(prefix):
+                        rows_by_prefix[prefix].append(row)
+        pending = _pending_rows(lambda attrs: 'container_id' in attrs)
+        for prefix, rows in rows_by_prefix.items():
+            rows_by_prefix[prefix] = _with_pending(rows, dict(
+                (name, attrs) for name, attrs in pending.iteritems() if attrs['container_id'].startswith(prefix)))
+        for prefix, rows in rows_by_prefix.iteritems():
+            if len(set(row['container_id'] for row in rows)) > 1:
+                _cache_rows(rows)
+                ambiguous.append(prefix)
+                del results[prefix]
+            else:
+                _cache_rows(rows, container_id=prefix)
+                results[prefix] = rows
+    return results, ambiguous
+
+
+def _query_task_ids(task_ids):
+    """
+    find all rows in the hash domain for a set of tasks. Tasks not in the cache are fetched from the DB in
+    batched lookups
+    :param task_ids: list. task ids
+    :return: dict. task id -> list of matching rows
+    """
+    results = dict((task_id, []) for task_id in task_ids)
+    missing = []
+    for task_id in results:
+        rows = map_cache.get_by_task_id(task_id) if _cache_enabled() else []
+        if rows:
+            results[task_id] = rows
+        else:
+            missing.append(task_id)
+    if len(missing) > 0:
+        rows_by_task = dict((task_id, []) for task_id in missing)
+        for row in db.find_by_task_ids(missing, settings.hash_schema):
+            rows_by_task[row['task_id']].append(row)
+        pending_by_task = dict((task_id, {}) for task_id in missing)
+        for name, attrs in _pending_rows(lambda attrs: attrs.get('task_id') in pending_by_task).iteritems():
+            pending_by_task[attrs['task_id']][name] = attrs
+        for task_id, rows in rows_by_task.iteritems():
+            rows = _with_pending(rows, pending_by_task[task_id])
+            _cache_rows(rows, task_id=task_id)
+            results[task_id] = rows
+    return results
+
+
+def _merge_rows(rows):
+    """
+    :param rows: list. rows of one container or task
+    :return: dict. attributes of all rows merged into one dict, where rows disagree the most recently sampled wins
+    """
+    merged = {}
+    for result in sorted(rows, key=lambda row: _to_float(row.get('sample_time', row.get('timestamp')))):
+        for k,v in result.iteritems():
+            merged[k] = v
+    return merged
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _encode_cursor(chunk, cursor):
+    return base64.urlsafe_b64encode(json.dumps([chunk, cursor]))
+
+
+def _decode_cursor(cursor):
+    """
+    :param cursor: str. cursor passed by the client, None for the first page
+    :return: tuple. (index of the chunk of values to page through, DB cursor within that chunk)
+    """
+    if not cursor:
+        return 0, None
+    try:
+        chunk, db_cursor = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        return int(chunk), db_cursor
+    except (TypeError, ValueError):
+        abort(400, 'invalid cursor')
+
+
+def _row_pages(attribute, values, limit, chunk=0, db_cursor=None):
+    """
+    Generator over pages of rows in the hash domain whose attribute is one of values. Values are looked up
+    settings.sdb_max_in_values at a time, a cursor is the chunk of values being paged through and the DB cursor
+    within it.
+    :param attribute: str. attribute to look rows up by, see db.find_page
+    :param limit: int. max rows per page
+    :return: generator of (list of rows, cursor of the next page or None after the last page)
+    """
+    chunks = [values[i:i + settings.sdb_max_in_values] for i in range(0, len(values), settings.sdb_max_in_values)]
+    while chunk < len(chunks):
+        rows, db_cursor = db.find_page(attribute, chunks[chunk], settings.hash_schema, limit, db_cursor)
+        if db_cursor is None:
+            chunk += 1
+        yield rows, _encode_cursor(chunk, db_cursor) if chunk < len(chunks) else None
+
+
+def _row_json(row):
+    return {'name': row.name, 'attributes': dict(row)}
+
+
+def _paged_rows_response(attribute, values):
+    """
+    Respond with every row instead of the rows merged into one dict, if the request asks for it.
+    ?format=ndjson streams the rows as lines of json. ?limit=N returns one page of at most N rows and the cursor
+    to pass as ?cursor= to get the next page.
+    :param attribute: str. attribute to look rows up by, see db.find_page
+    :param values: list. values of the attribute
+    :return: response, None if the request didn't ask for every row
+    """
+    if request.args.get('format') != 'ndjson' and 'limit' not in request.args:
+        return None
+    chunk, db_cursor = _decode_cursor(request.args.get('cursor'))
+    if request.args.get('format') == 'ndjson':
+        pages = _row_pages(attribute, values, settings.stream_page_size, chunk, db_cursor)
+
+        def generate():
+            for rows, _ in pages:
+                for row in rows:
+                    yield json.dumps(_row_json(row)) + '\n'
+        return Response(generate(), mimetype='application/x-ndjson')
+    try:
+        limit = min(max(int(request.args['limit']), 1), settings.sdb_max_select_limit)
+    except ValueError:
+        abort(400, 'limit must be an integer')
+    rows, next_cursor = [], None
+    for rows, next_cursor in _row_pages(attribute, values, limit, chunk, db_cursor):
+        if rows:
+            # skip over chunks of values without any rows
+            break
+    return jsonify({'rows': [_row_json(row) for row in rows], 'next_cursor': next_cursor})
+
+
+def _event_attributes(event):
+    """
+    :param event: dict. event as reported by the agent
+    :return: dict. attributes to store. Events from agents that don't send the ids of the container get them from
+    the cached map entry the event is about
+    """
+    attrs = {'event_id': event['event_id'], 'event_action': event['event'], 'timestamp': event['timestamp']}
+    entry = event
+    if 'container_id' not in event and _cache_enabled():
+        entry = map_cache.get(event['event_id']) or {}
+    for k in ('container_id', 'task_id', 'task_name'):
+        if k in entry:
+            attrs[k] = entry[k]
+    return attrs
+
+
+def _write_events(events):
+    """
+    write events to the partitions of the times they happened
+    :param events: dict. item name -> event attributes
+    """
+    partitions = {}
+    for name, attrs in events.iteritems():
+        partitions.setdefault(event_partitions.partition_for(attrs['timestamp']), {})[name] = attrs
+    for partition, items in partitions.iteritems():
+        _write(items, partition)
+        event_partitions.partition_created(partition)
+    changes.publish([dict(e, type='event') for e in sorted(events.itervalues(), key=lambda e: e['timestamp'])])
+
 
 @ecs_id_mapper.route('/report/event', methods=['POST'])
 def report_event():
@@ -23,28 +440,43 @@ def report_event():
         abort(400)
     logger.info('Received event from {}'.format(request.remote_addr))
     logger.debug('Event payload {}'.format(request.json))
-    event_id = request.json['event_id']
-    event = request.json['event']
-    timestamp = request.json['timestamp']
-    db.put(str(timestamp)+"_"+str(event_id),
-           {'container_id': event_id, 'event_action': event, 'timestamp': timestamp},
-           'ecs_id_mapper_events')
+    try:
+        attrs = _event_attributes(request.json)
+    except (KeyError, TypeError) as e:
+        logger.error('Invalid event: {}'.format(e))
+        abort(400)
+    _write_events({str(attrs['timestamp'])+"_"+str(attrs['event_id']): attrs})
     return 'true'
 
 
-@ecs_id_mapper.route('/report/map', methods=['POST'])
-def report_map():
+@ecs_id_mapper.route('/report/events', methods=['POST'])
+def report_events():
     """
-    update DB with new version of a container instance's id map
+    update DB with a batch of container task state change events
     :return: str. 'true' if successful
     """
-    if not request.json:
-        logger.error('received non-json data')
+    if not isinstance(request.json, list):
+        logger.error('received non-json or non-list data')
         abort(400)
-    logger.info('Received map update from {}'.format(request.remote_addr))
-    logger.debug('Map update {}'.format(request.json))
-    _map = request.json
+    logger.info('Received {} events from {}'.format(len(request.json), request.remote_addr))
+    logger.debug('Events payload {}'.format(request.json))
+    events = {}
+    try:
+        for e in request.json:
+            events[str(e['timestamp'])+"_"+str(e['event_id'])] = _event_attributes(e)
+    except (KeyError, TypeError) as e:
+        logger.error('Invalid event in payload: {}'.format(e))
+        abort(400)
+    if len(events) > 0:
+        _write_events(events)
+    return 'true'
 
+
+def _store_map(_map):
+    """
+    add monitoring tool URLs to id map entries and write them to the DB, cache and prefix index
+    :param _map: dict. id map entries keyed by their item name
+    """
     for k,v in _map.iteritems():
         container_attributes = copy.deepcopy(v)
         try:
@@ -58,7 +490,105 @@ def report_map():
         except KeyError as e:
             logger.error('Unable to find keys in response: {}'.format(e))
         _map[k] = container_attributes
-    db.batch_put(_map, 'ecs_id_mapper_hash')
+    _write(_map, settings.hash_schema)
+    for container_attributes in _map.itervalues():
+        if 'container_id' in container_attributes:
+            container_ids.add(container_attributes['container_id'])
+    if _cache_enabled():
+        map_cache.put_many(_map)
+    changes.publish([{'type': 'map', 'name': k, 'attributes': v} for k, v in _map.iteritems()])
+    if settings.nr_resolver == 'true':
+        for k, container_attributes in _map.iteritems():
+            if container_attributes.get('desired_status') == 'RUNNING' and 'container_id' in container_attributes:
+                new_relic_url_generator.queue_container(k, container_attributes['container_id'])
+
+
+def _get_host_generation(host):
+    """
+    :param host: str. host identifier the agent reports with
+    :return: int. generation of the last map we stored for the host, None if we have none
+    """
+    item = write_buffer.get(host, settings.hosts_schema) if write_buffer else None
+    if item is None:
+        item = db.get(host, settings.hosts_schema)
+    if item is None or 'generation' not in item:
+        return None
+    return int(item['generation'])
+
+
+def _set_host_generation(host, generation):
+    _write({host: {'generation': generation}}, settings.hosts_schema)
+
+
+@ecs_id_mapper.route('/report/map', methods=['POST'])
+def report_map():
+    """
+    update DB with new version of a container instance's id map. Agents using delta reporting pass
+    ?host=<host>&generation=<generation> so later deltas can be checked against this map
+    :return: str. 'true' if successful
+    """
+    if not request.json:
+        logger.error('received non-json data')
+        abort(400)
+    host = request.args.get('host')
+    generation = request.args.get('generation')
+    if host and generation:
+        try:
+            generation = int(generation)
+        except ValueError as e:
+            logger.error('Invalid map generation: {}'.format(e))
+            abort(400)
+    logger.info('Received map update from {}'.format(request.remote_addr))
+    logger.debug('Map update {}'.format(request.json))
+    _store_map(request.json)
+    if host and generation is not None:
+        _set_host_generation(host, generation)
+    return 'true'
+
+
+@ecs_id_mapper.route('/report/map/delta', methods=['POST'])
+def report_map_delta():
+    """
+    update DB with the entries of a container instance's id map that changed since the map with generation
+    base_generation. If we don't hold base_generation for the host the agent is told to resync with a
+    full map.
+    :return: str. 'true' if successful, 'resync' with a 409 if the agent has to send its full map
+    """
+    if not isinstance(request.json, dict):
+        logger.error('received non-json or non-dict data')
+        abort(400)
+    logger.info('Received map delta from {}'.format(request.remote_addr))
+    logger.debug('Map delta {}'.format(request.json))
+    try:
+        host = request.json['host']
+        generation = int(request.json['generation'])
+        base_generation = int(request.json['base_generation'])
+    except (KeyError, ValueError, TypeError) as e:
+        logger.error('Invalid map delta: {}'.format(e))
+        abort(400)
+    added = request.json.get('added', {})
+    changed = request.json.get('changed', {})
+    removed = request.json.get('removed', [])
+    if not all(isinstance(entries, dict) and all(isinstance(v, dict) for v in entries.itervalues())
+               for entries in (added, changed)) or \
+            not isinstance(removed, list) or not all(isinstance(k, basestring) for k in removed):
+        logger.error('Invalid map delta: added and changed must map item names to entries, removed must list names')
+        abort(400)
+    current_generation = _get_host_generation(host)
+    if current_generation != base_generation:
+        logger.info('Map delta from {} is based on generation {}, we have {}. Requesting resync'.format(
+            host, base_generation, current_generation))
+        return 'resync', 409
+    _map = {}
+    _map.update(added)
+    _map.update(changed)
+    if len(_map) > 0:
+        _store_map(_map)
+    if _cache_enabled():
+        for k in removed:
+            map_cache.invalidate(k)
+    changes.publish([{'type': 'removed', 'name': k} for k in removed])
+    _set_host_generation(host, generation)
     return 'true'
 
 
@@ -70,16 +600,10 @@ def get_container_by_container_id(container_id):
     for each instance of a container
     :return: str. task id
     """
-    if len(container_id) <= 12:
-        query = 'select * from `{schema}` where container_id like "{short_container_id}%"'.\
-            format(schema=settings.hash_schema, short_container_id=container_id)
-    else:
-        query = 'select * from `{schema}` where container_id="{container_id}"'.\
-            format(schema=settings.hash_schema, container_id=container_id)
-    resultset = db.search_domain(query, settings.hash_schema)
+    resultset = _query_container_id(container_id)
     try:
-        return resultset.next()['task_id']
-    except StopIteration:
+        return resultset[0]['task_id']
+    except IndexError:
         abort(404)
 
 
@@ -91,23 +615,44 @@ def get_all_container_attributes_by_container_id(container_id):
     for each instance of a container
     :return: str. json encoded
     """
-    if len(container_id) <= 12:
-        query = 'select * from `{schema}` where container_id like "{short_container_id}%"'.\
-            format(schema=settings.hash_schema, short_container_id=container_id)
-    else:
-        query = 'select * from `{schema}` where container_id="{container_id}"'.\
-            format(schema=settings.hash_schema, container_id=container_id)
-    resultset = db.search_domain(query, settings.hash_schema)
-    json_results = {}
+    full_container_id = _resolve_container_id(container_id)
+    paged = _paged_rows_response('container_prefix' if len(full_container_id) <= 12 else 'container_id',
+                                 [full_container_id])
+    if paged:
+        return paged
+    resultset = _query_container_id(container_id)
     logger.debug(resultset)
-    for result in resultset:
-        for k,v in result.iteritems():
-            json_results[k] = v
+    json_results = _merge_rows(resultset)
     if len(json_results) == 0:
         abort(404)
     return jsonify(json_results)
 
 
+def _bulk_ids():
+    """
+    :return: list. ids posted as a json list to a bulk query method
+    """
+    ids = request.json
+    if not isinstance(ids, list) or not all(isinstance(i, basestring) for i in ids):
+        logger.error('received non-json or non-list data')
+        abort(400)
+    if len(ids) > settings.bulk_query_max_ids:
+        abort(413, 'at most {} ids per request'.format(settings.bulk_query_max_ids))
+    return ids
+
+
+@ecs_id_mapper.route('/query/container_ids', methods=['POST'])
+def get_all_container_attributes_by_container_ids():
+    """
+    lookup all attributes of many containers at once
+    :return: json. {"results": {container id: attributes}, "not_found": [...], "ambiguous": [...]}
+    """
+    results, ambiguous = _query_container_ids(_bulk_ids())
+    return jsonify({'results': dict((k, _merge_rows(rows)) for k, rows in results.iteritems() if rows),
+                    'not_found': [k for k, rows in results.iteritems() if not rows],
+                    'ambiguous': ambiguous})
+
+
 @ecs_id_mapper.route('/query/container_id/<container_id>/cadvisor', methods=['GET'])
 def get_cadvisor_url_by_container_id(container_id):
     """
@@ -116,22 +661,16 @@ def get_cadvisor_url_by_container_id(container_id):
     daemon for each instance of a container
     :return: str.
     """
-    if len(container_id) <= 12:
-        query = 'select * from `{schema}` where container_id like "{short_container_id}%"'.\
-            format(schema=settings.hash_schema, short_container_id=container_id)
-    else:
-        query = 'select * from `{schema}` where container_id="{container_id}"'.\
-            format(schema=settings.hash_schema, container_id=container_id)
-    resultset = db.search_domain(query, settings.hash_schema)
+    resultset = _query_container_id(container_id)
     try:
-        d = resultset.next()
+        d = resultset[0]
         instance_ip = d['instance_ip']
         cadvisor_url = "http://{}:{}/docker/{}".format(instance_ip, settings.cadvisor_port, container_id)
         if request.args.get('redir') and request.args.get('redir').lower() == "true":
             return redirect(cadvisor_url, 302)
         else:
             return cadvisor_url
-    except StopIteration:
+    except IndexError:
         abort(404)
 
 
@@ -142,19 +681,9 @@ def get_all_container_urls(container_id):
     :param container_id: str. container_id
     :return: json
     """
-    if len(container_id) <= 12:
-        query = 'select * from `{schema}` where container_id like "{short_container_id}%"'.\
-            format(schema=settings.hash_schema, short_container_id=container_id)
-    else:
-        query = 'select * from `{schema}` where container_id="{container_id}"'.\
-            format(schema=settings.hash_schema, container_id=container_id)
-    resultset = db.search_domain(query, settings.hash_schema)
-    json_results = {}
+    resultset = _query_container_id(container_id)
     logger.debug(resultset)
-    for result in resultset:
-        for k,v in result.iteritems():
-            json_results[k] = v
-    return jsonify(json_results)
+    return jsonify(_merge_rows(resultset))
 
 
 @ecs_id_mapper.route('/query/task_id/<task_id>', methods=['GET'])
@@ -164,12 +693,10 @@ def get_container_by_task_id(task_id):
     :param task_id: str. Task id is a uuid like string generated by ECS for each instance of a task
     :return: str. container id
     """
-    resultset = db.search_domain(
-        'select * from `ecs_id_mapper_hash` where task_id="{task_id}"'.
-        format(task_id=task_id), 'ecs_id_mapper_hash')
+    resultset = _query_task_id(task_id)
     try:
-        return resultset.next()['container_id']
-    except StopIteration:
+        return resultset[0]['container_id']
+    except IndexError:
         abort(404)
 
 
@@ -181,14 +708,13 @@ def get_all_container_attributes_by_task_id(task_id, json=True):
     :param json: bool. return a serialized json response (true) or a dict (false)
     :return: str. json encoded
     """
-    resultset = db.search_domain(
-            'select * from `ecs_id_mapper_hash` where task_id="{task_id}"'.
-            format(task_id=task_id), 'ecs_id_mapper_hash')
-    json_results = {}
+    if json:
+        paged = _paged_rows_response('task_id', [task_id])
+        if paged:
+            return paged
+    resultset = _query_task_id(task_id)
     logger.debug(resultset)
-    for result in resultset:
-        for k,v in result.iteritems():
-            json_results[k] = v
+    json_results = _merge_rows(resultset)
     if len(json_results) == 0:
         abort(404)
     if json:
@@ -196,6 +722,17 @@ def get_all_container_attributes_by_task_id(task_id, json=True):
     return json_results
 
 
+@ecs_id_mapper.route('/query/task_ids', methods=['POST'])
+def get_all_container_attributes_by_task_ids():
+    """
+    lookup all attributes of the containers of many tasks at once
+    :return: json. {"results": {task id: attributes}, "not_found": [...]}
+    """
+    results = _query_task_ids(set(_bulk_ids()))
+    return jsonify({'results': dict((k, _merge_rows(rows)) for k, rows in results.iteritems() if rows),
+                    'not_found': [k for k, rows in results.iteritems() if not rows]})
+
+
 @ecs_id_mapper.route('/query/task_id/<task_id>/cadvisor', methods=['GET'])
 def get_cadvisor_url_by_task_id(task_id):
     """
@@ -203,11 +740,9 @@ def get_cadvisor_url_by_task_id(task_id):
     :param task_id: Task id is a uuid like string generated by ECS for each instance of a task
     :return: str.
     """
-    resultset = db.search_domain(
-            'select * from `ecs_id_mapper_hash` where task_id="{task_id}"'.
-            format(task_id=task_id), 'ecs_id_mapper_hash')
+    resultset = _query_task_id(task_id)
     try:
-        d = resultset.next()
+        d = resultset[0]
         instance_ip = d['instance_ip']
         container_id = d['container_id']
         cadvisor_url = "http://{}:{}/docker/{}".format(instance_ip, settings.cadvisor_port, container_id)
@@ -215,7 +750,7 @@ def get_cadvisor_url_by_task_id(task_id):
             return redirect(cadvisor_url, 302)
         else:
             return cadvisor_url
-    except StopIteration:
+    except IndexError:
         abort(404)
 
 
@@ -226,17 +761,15 @@ def get_graylog_url_by_task_id(task_id):
     :param  task_id: Task id is a uuid like string generated by ECS for each instance of a task
     :return: str.
     """
-    resultset = db.search_domain(
-            'select * from `ecs_id_mapper_hash` where task_id="{task_id}"'.
-            format(task_id=task_id), 'ecs_id_mapper_hash')
+    resultset = _query_task_id(task_id)
     try:
-        d = resultset.next()
+        d = resultset[0]
         graylog_url = d['graylog_url']
         if request.args.get('redir') and request.args.get('redir').lower() == "true":
             return redirect(graylog_url, 302)
         else:
             return graylog_url
-    except StopIteration:
+    except IndexError:
         abort(404)
 
 
@@ -247,24 +780,26 @@ def get_newrelic_url_by_task_id(task_id):
     :param  task_id: Task id is a uuid like string generated by ECS for each instance of a task
     :return: str.
     """
-    resultset = db.search_domain(
-            'select * from `ecs_id_mapper_hash` where task_id="{task_id}"'.
-            format(task_id=task_id), 'ecs_id_mapper_hash')
+    resultset = _query_task_id(task_id)
     try:
-        d = resultset.next()
+        d = resultset[0]
         new_relic_url = d['new_relic_url']
         if request.args.get('redir') and request.args.get('redir').lower() == "true":
             return redirect(new_relic_url, 302)
         else:
             return new_relic_url
-    except StopIteration:
+    except IndexError:
         abort(404)
     except KeyError:
         # We don't have the new relic url yet
         try:
-            logger.info('NR URL not found in DB. Querying NR API')
-            new_relic_url = new_relic_url_generator.get_new_relic_app_instance_url(d['container_id'])
-            db.put(d.name, {"new_relic_url": new_relic_url}, settings.hash_schema, replace=True)
+            logger.info('NR URL not found in DB. Checking New Relic cache')
+            new_relic_url = new_relic_url_generator.get_cached_app_instance_url(d['container_id'])
+            if new_relic_url is None:
+                # don't make the caller wait on New Relic, let the background resolver look it up
+                new_relic_url_generator.queue_container(d.name, d['container_id'])
+                abort(404, 'New Relic URL for task_id {} is not resolved yet'.format(task_id))
+            map_cache.update(d.name, {"new_relic_url": new_relic_url})
             if request.args.get('redir') and request.args.get('redir').lower() == "true":
                 return redirect(new_relic_url, 302)
             else:
@@ -307,43 +842,218 @@ def get_all_service_attributes(cluster_name, service_name):
                "cluster_name": cluster_name,
                "tasks": []}
     try:
-        for task in ecs_api.get_task_ids_from_service(service_name, cluster_name):
-            try:
-                task_json = get_all_container_attributes_by_task_id(task, json=False)
-                service['tasks'].append(task_json)
-            except NotFound as e:
-                logger.warn('ECS API told us about task {} but unable to find in our database'.
-                            format(task))
-        return jsonify(service)
+        task_ids = ecs_api.get_task_ids_from_service(service_name, cluster_name)
     except:
         abort(404, 'ECS service not found')
+    paged = _paged_rows_response('task_id', sorted(task_ids))
+    if paged:
+        return paged
+    task_rows = _query_task_ids(task_ids)
+    for task in task_ids:
+        if len(task_rows[task]) == 0:
+            logger.warn('ECS API told us about task {} but unable to find in our database'.
+                        format(task))
+            continue
+        service['tasks'].append(_merge_rows(task_rows[task]))
+    return jsonify(service)
+
+
+def _float_arg(name, default):
+    try:
+        return float(request.args.get(name, default))
+    except ValueError:
+        abort(400, '{} must be a number'.format(name))
+
+
+def _events_response(attribute, value):
+    """
+    Page of the events with attribute equal to value between ?start= and ?end= (epoch seconds, default the last
+    hour), oldest first. Only the partitions overlapping the time range are read.
+    :param attribute: str. 'container_id', 'task_id' or 'task_name'
+    :return: json. {"events": [...], "next_cursor": ...}, pass next_cursor as ?cursor= to get the next page
+    """
+    limit = min(max(_int_arg('limit', 100), 1), settings.sdb_max_select_limit)
+    partition = db_cursor = None
+    if request.args.get('cursor'):
+        # the cursor carries the time range of the first page, so the select a DB cursor belongs to stays the same
+        try:
+            partition, db_cursor, start, end = json.loads(base64.urlsafe_b64decode(str(request.args['cursor'])))
+            start, end = float(start), float(end)
+        except (TypeError, ValueError):
+            abort(400, 'invalid cursor')
+    else:
+        end = _float_arg('end', time.time())
+        start = _float_arg('start', end - 3600)
+    partitions = event_partitions.partitions_between(event_partitions.known_domains(), start, end)
+    if partition is not None:
+        partitions = [p for p in partitions if p >= partition]
+        if not partitions or partitions[0] != partition:
+            db_cursor = None  # the partition was dropped since, carry on with the next one
+
+    def encode_cursor(partition, db_cursor):
+        return base64.urlsafe_b64encode(json.dumps([partition, db_cursor, start, end]))
+    events = []
+    next_cursor = None
+    for i, partition in enumerate(partitions):
+        if len(events) == limit:
+            next_cursor = encode_cursor(partition, None)
+            break
+        rows, db_cursor = db.find_events(attribute, value, start, end, partition, limit - len(events), db_cursor)
+        events.extend(dict(row) for row in rows)
+        if db_cursor:
+            next_cursor = encode_cursor(partition, db_cursor)
+            break
+    return jsonify({'events': events, 'next_cursor': next_cursor})
 
 
 @ecs_id_mapper.route('/query/events/<task_name>', methods=['GET'])
 def get_events_by_task_name(task_name):
     """
-    Get the graylog URL for a given container
+    Get the history of events of the containers of a task definition
     :param  task_name: This is the name of the task as defined in the task ECS Task Definition
+    :return: json
+    """
+    return _events_response('task_name', task_name)
+
+
+@ecs_id_mapper.route('/query/events/container_id/<container_id>', methods=['GET'])
+def get_events_by_container_id(container_id):
+    """
+    Get the history of events of a container
+    :param container_id: str. full container id, or a short (12 chars or fewer) prefix of one
+    :return: json
+    """
+    return _events_response('container_id', _resolve_container_id(container_id))
+
+
+@ecs_id_mapper.route('/query/events/task_id/<task_id>', methods=['GET'])
+def get_events_by_task_id(task_id):
+    """
+    Get the history of events of the containers of a task
+    :param task_id: str. Task id is a uuid like string generated by ECS for each instance of a task
+    :return: json
+    """
+    return _events_response('task_id', task_id)
+
+
+@ecs_id_mapper.route('/export', methods=['GET'])
+def export_map():
     """
+    Every entry in the hash domain, for clients that want to do their lookups locally. Filter with
+    ?cluster=<cluster_name> and ?status=<desired_status>. The export is streamed a page at a time, each page is a
+    msgpack object if msgpack is installed, otherwise a line of compact JSON; ?format=json or ?format=msgpack picks
+    one.
+    The ETag is derived from the position of the change feed, so a client polling with If-None-Match gets a 304
+    without a scan while this process saw no changes. Writes the feed doesn't carry (other processes, New Relic
+    URLs) change the ETag within settings.export_etag_ttl seconds.
+    :return: columnar pages, see export.encode. 304 if it matches If-None-Match
+    """
+    cluster = request.args.get('cluster')
+    status = request.args.get('status')
+    fmt = request.args.get('format', export.default_format())
+    if fmt not in export.MIMETYPES or (fmt == 'msgpack' and not export.msgpack):
+        abort(400, 'unsupported format {}'.format(fmt))
+    etag = export.etag(changes.epoch, changes.seq, int(time.time() // settings.export_etag_ttl), cluster, status,
+                       fmt)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    def pages():
+        cursor = None
+        while True:
+            rows, cursor = db.select_page(settings.hash_schema, settings.stream_page_size, cursor,
+                                          cluster_name=cluster, desired_status=status)
+            yield rows
+            if cursor is None:
+                return
+    response = Response(export.encode_pages(pages(), fmt), mimetype=export.MIMETYPES[fmt])
+    response.set_etag(etag)
+    return response
 
-    resultset=db.search_domain(
-            'select * from `ecs_id_mapper_hash` where task_name="{task_name}"'.
-            format(task_name=task_name), 'ecs_id_mapper_hash')
+
+def _int_arg(name, default):
     try:
-        d = resultset.next()
-        contiainer_id = d['contianer_id']
-        print contiainer_id
-    except StopIteration:
-        abort(404)
+        return int(request.args.get(name, default))
+    except ValueError:
+        abort(400, '{} must be an integer'.format(name))
+
 
-    resultset = db.search_domain(
-            'select * from `ecs_id_mapper_events` where container_id="{contiainer_id}"'.
-            format(contiainer_id=contiainer_id), 'ecs_id_mapper_events')
+def _feed_full():
+    """
+    :return: response. 503 for a subscriber of the change feed when all subscriber slots are taken
+    """
+    return Response('Too many change feed subscribers, retry later', status=503,
+                    headers={'Retry-After': str(settings.change_feed_heartbeat)})
+
+
+@ecs_id_mapper.route('/changes', methods=['GET'])
+def get_changes():
+    """
+    Feed of changes to the map: entries added or changed by map reports, entries removed by map deltas and
+    container events. Long-polls until there are changes after ?since=<seq> or ?timeout= seconds passed, without
+    since only changes from now on are returned. With ?format=sse or Accept: text/event-stream the changes are
+    streamed as server-sent events instead, resuming after Last-Event-ID.
+    :return: json. {"epoch": ..., "changes": [...], "last_seq": ..., "reset": bool}. reset is true when changes
+    after since are no longer buffered or since came from a previous run of the server (epoch differs), the
+    subscriber has to resync from /export and continue from last_seq
+    """
+    since = request.headers.get('Last-Event-ID', request.args.get('since'))
     try:
-        d = resultset.next()
-        return d
-    except StopIteration:
-        abort(404)
+        since = changes.seq if since is None else int(since)
+    except ValueError:
+        abort(400, 'since must be an integer')
+    reset = request.args.get('epoch', str(changes.epoch)) != str(changes.epoch)
+    if reset:
+        since = changes.seq
+    limit = min(max(_int_arg('limit', settings.change_feed_page_size), 1), settings.change_feed_page_size)
+    # waiting for changes would hold up the IOLoop if requests aren't handled on threads
+    blocking_ok = settings.server_threads > 0
+    if request.args.get('format') == 'sse' or 'text/event-stream' in request.headers.get('Accept', ''):
+        if not blocking_ok:
+            abort(400, 'server-sent events need server_threads > 0')
+        if not changes.subscribe():
+            return _feed_full()
+
+        def stream(since, reset):
+            try:
+                yield 'event: hello\ndata: {}\n\n'.format(json.dumps({'epoch': changes.epoch, 'reset': reset}))
+                while True:
+                    batch, gap = changes.read(since, limit, settings.change_feed_heartbeat)
+                    if gap:
+                        yield 'event: reset\ndata: {}\n\n'.format(json.dumps({'last_seq': changes.seq}))
+                        since = changes.seq
+                        continue
+                    if not batch:
+                        # keeps proxies from timing out the connection and tells us when the subscriber is gone
+                        yield ': heartbeat\n\n'
+                        continue
+                    for change in batch:
+                        yield 'id: {}\ndata: {}\n\n'.format(change['seq'], json.dumps(change))
+                    since = batch[-1]['seq']
+            finally:
+                # runs when the response is closed after the subscriber went away
+                changes.unsubscribe()
+        return Response(stream(since, reset), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    timeout = min(max(_int_arg('timeout', settings.change_feed_max_wait), 0), settings.change_feed_max_wait)
+    if not blocking_ok:
+        timeout = 0
+    if timeout > 0:
+        if not changes.subscribe():
+            return _feed_full()
+        try:
+            batch, gap = changes.read(since, limit, timeout)
+        finally:
+            changes.unsubscribe()
+    else:
+        batch, gap = changes.read(since, limit, timeout)
+    if gap:
+        reset, batch = True, []
+    return jsonify({'epoch': changes.epoch,
+                    'changes': batch,
+                    'last_seq': batch[-1]['seq'] if batch else changes.seq if reset else since,
+                    'reset': reset})
 
 
 @ecs_id_mapper.route('/health')
@@ -355,6 +1065,48 @@ def check_health():
         abort(500)
 
 
+@ecs_id_mapper.route('/stats')
+def get_stats():
+    """
+    Internal counters of the server
+    :return: json
+    """
+    stats = {'cache': map_cache.stats(),
+             'prefix_index': {'container_ids': len(container_ids)}}
+    if write_buffer:
+        stats['write_behind'] = write_buffer.stats()
+    stats['change_feed'] = changes.stats()
+    if domain_compactor:
+        stats['compactor'] = domain_compactor.stats()
+    if settings.nr_index == 'true':
+        stats['new_relic_index'] = new_relic_url_generator.index_stats()
+    return jsonify(stats)
+
+
+if settings.prefix_index_warm == 'true':
+    _warm_thread = threading.Thread(target=_warm_prefix_index, name='prefix_index_warm')
+    _warm_thread.daemon = True
+    _warm_thread.start()
+
+if write_buffer:
+    write_buffer.start()
+
+if settings.nr_resolver == 'true':
+    new_relic_url_generator.start_resolver()
+
+domain_compactor = None
+if settings.compactor == 'true':
+    domain_compactor = compactor.Compactor(settings.hash_schema, settings.events_schema,
+                                           stopped_retention=settings.compactor_stopped_retention,
+                                           event_retention=settings.compactor_event_retention,
+                                           partition_retention=settings.compactor_partition_retention,
+                                           interval=settings.compactor_interval,
+                                           delete_rate=settings.compactor_delete_rate,
+                                           max_rows=settings.compactor_max_rows,
+                                           on_delete=_forget_rows)
+    domain_compactor.start()
+
+
 if __name__ == '__main__':
     # This starts the built in flask server, not designed for production use
     logger.info('Starting server...')
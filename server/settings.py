@@ -17,10 +17,61 @@ graylog_url = getenv('graylog_url',
                      "http://{graylog_fqdn}/search?rangetype=relative&fields=message%2Csource&width=1639&relative=86400&q=tag%3Adocker.{container_id}#fields=log")
 log_level = getenv('log_level', 'INFO')
 server_port = getenv('server_port', 5001)
+server_processes = int(getenv('server_processes', 1))
+server_threads = int(getenv('server_threads', 16))
 dev_mode = getenv('dev_mode', 'false')
+storage_backend = getenv('storage_backend', 'simpledb')
+sqlite_path = getenv('sqlite_path', 'ecs_id_mapper.db')
+# cached rows are only invalidated in the process that writes them, off by default when several processes serve
+cache_enabled = getenv('cache_enabled', 'true' if server_processes == 1 else 'false')
+cache_max_entries = int(getenv('cache_max_entries', 10000))
+cache_ttl = int(getenv('cache_ttl', 30))
+prefix_index_warm = getenv('prefix_index_warm', 'true')
+# only for a single server with server_processes=1, which sees every map report
+prefix_index_authoritative = getenv('prefix_index_authoritative', 'false')
+max_request_size = int(getenv('max_request_size', 32 * 1024 * 1024))
+ecs_task_cache_ttl = int(getenv('ecs_task_cache_ttl', 30))
+nr_resolver = getenv('nr_resolver', 'true')
+nr_resolver_interval = float(getenv('nr_resolver_interval', 10))
+nr_resolver_batch_size = int(getenv('nr_resolver_batch_size', 25))
+nr_sweep_window = int(getenv('nr_sweep_window', 600))
+nr_positive_ttl = int(getenv('nr_positive_ttl', 3600))
+nr_negative_ttl = int(getenv('nr_negative_ttl', 120))
+nr_index = getenv('nr_index', 'true')
+nr_index_interval = int(getenv('nr_index_interval', 60))
+nr_index_timeout = float(getenv('nr_index_timeout', 10))
+write_behind = getenv('write_behind', 'false')
+write_behind_spool = getenv('write_behind_spool', 'ecs_id_mapper.spool')
+write_behind_flush_interval = float(getenv('write_behind_flush_interval', 1))
+write_behind_fsync = getenv('write_behind_fsync', 'true')
+# SimpleDB allows at most 20 values in an `in (...)` comparison
+sdb_max_in_values = 20
+# and at most 2500 items per select
+sdb_max_select_limit = 2500
+stream_page_size = int(getenv('stream_page_size', 250))
+bulk_query_max_ids = int(getenv('bulk_query_max_ids', 1000))
+event_partition = getenv('event_partition', 'day')
+event_partition_cache_ttl = float(getenv('event_partition_cache_ttl', 60))
+compactor = getenv('compactor', 'false')
+compactor_interval = float(getenv('compactor_interval', 3600))
+compactor_stopped_retention = float(getenv('compactor_stopped_retention', 7 * 86400))
+compactor_event_retention = float(getenv('compactor_event_retention', 30 * 86400))
+compactor_partition_retention = float(getenv('compactor_partition_retention', 90 * 86400))
+compactor_delete_rate = float(getenv('compactor_delete_rate', 50))
+compactor_max_rows = int(getenv('compactor_max_rows', 10000))
+export_etag_ttl = float(getenv('export_etag_ttl', 30))
+change_feed_size = int(getenv('change_feed_size', 10000))
+change_feed_page_size = int(getenv('change_feed_page_size', 500))
+change_feed_max_wait = int(getenv('change_feed_max_wait', 30))
+change_feed_heartbeat = float(getenv('change_feed_heartbeat', 15))
+# each waiting subscriber holds a request thread, leave the rest for lookups
+change_feed_max_subscribers = int(getenv('change_feed_max_subscribers', max(server_threads // 4, 1)))
+sdb_write_threads = int(getenv('sdb_write_threads', 8))
+sdb_max_attempts = int(getenv('sdb_max_attempts', 5))
 hash_schema = 'ecs_id_mapper_hash'
 events_schema = 'ecs_id_mapper_events'
 services_schema = 'ecs_id_mapper_services'
+hosts_schema = 'ecs_id_mapper_hosts'
 new_relic_app_instance_url = "https://rpm.newrelic.com/accounts/{account_id}/applications/" \
                              "{application_id}_i{application_instance_id}"
 
@@ -0,0 +1,253 @@
+import sqlite3
+import threading
+import json
+import settings
+import logging
+
+logger = logging.getLogger('ecs_id_mapper')
+
+# attributes we look items up by are copied out of the json encoded attrs into their own indexed columns
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS domains (name TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS items (
+    domain TEXT NOT NULL,
+    name TEXT NOT NULL,
+    attrs TEXT NOT NULL,
+    container_id TEXT,
+    task_id TEXT,
+    task_name TEXT,
+    sample_time REAL,
+    timestamp REAL,
+    desired_status TEXT,
+    cluster_name TEXT,
+    PRIMARY KEY (domain, name)
+);
+CREATE INDEX IF NOT EXISTS items_container_id ON items (domain, container_id);
+CREATE INDEX IF NOT EXISTS items_task_id ON items (domain, task_id);
+CREATE INDEX IF NOT EXISTS items_task_name ON items (domain, task_name);
+CREATE INDEX IF NOT EXISTS items_sample_time ON items (domain, sample_time);
+CREATE INDEX IF NOT EXISTS items_timestamp ON items (domain, timestamp);
+CREATE INDEX IF NOT EXISTS items_desired_status ON items (domain, desired_status, sample_time);
+CREATE INDEX IF NOT EXISTS items_cluster_name ON items (domain, cluster_name, name);
+"""
+_COLUMNS = ('domain', 'name', 'attrs', 'container_id', 'task_id', 'task_name', 'sample_time', 'timestamp',
+            'desired_status', 'cluster_name')
+_INSERT = 'INSERT OR REPLACE INTO items ({}) VALUES ({})'.format(', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS)))
+
+_db = {}
+_lock = threading.RLock()
+
+
+class Item(dict):
+    """
+    attributes of a stored item, with the item name in .name like a boto sdb Item
+    """
+    def __init__(self, name, attrs):
+        super(Item, self).__init__(attrs)
+        self.name = name
+
+
+def _get_db():
+    with _lock:
+        if 'conn' not in _db:
+            logger.info('Opening sqlite database {}'.format(settings.sqlite_path))
+            conn = sqlite3.connect(settings.sqlite_path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SCHEMA)
+            _db['conn'] = conn
+        return _db['conn']
+
+
+def _to_real(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _row_values(domain, name, attrs):
+    return (domain, name, json.dumps(attrs),
+            attrs.get('container_id'), attrs.get('task_id'), attrs.get('task_name'),
+            _to_real(attrs.get('sample_time')), _to_real(attrs.get('timestamp')),
+            attrs.get('desired_status'), attrs.get('cluster_name'))
+
+
+def _write(conn, domain, items):
+    """
+    Merge attributes into stored items. Like a SimpleDB put with replace=True, attributes that are not
+    passed keep their stored value.
+    """
+    conn.execute('INSERT OR IGNORE INTO domains (name) VALUES (?)', (domain,))
+    rows = []
+    for name, attrs in items.iteritems():
+        existing = conn.execute('SELECT attrs FROM items WHERE domain=? AND name=?', (domain, name)).fetchone()
+        merged = json.loads(existing[0]) if existing else {}
+        merged.update(attrs)
+        rows.append(_row_values(domain, name, merged))
+    conn.executemany(_INSERT, rows)
+
+
+def _select(where, params):
+    with _lock:
+        rows = _get_db().execute('SELECT name, attrs FROM items WHERE ' + where, params).fetchall()
+    return [Item(name, json.loads(attrs)) for name, attrs in rows]
+
+
+def batch_put(items, domain):
+    with _lock:
+        conn = _get_db()
+        with conn:
+            _write(conn, domain, items)
+    return True
+
+
+def batch_delete(keys, domain):
+    keys = list(keys)
+    with _lock:
+        conn = _get_db()
+        with conn:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                conn.execute('DELETE FROM items WHERE domain=? AND name IN ({})'.format(','.join('?' * len(chunk))),
+                             [domain] + chunk)
+    return True
+
+
+def get(key, domain, consistent_read=True):
+    items = _select('domain=? AND name=?', (domain, key))
+    return items[0] if items else None
+
+
+def get_all_dom(domain):
+    return _select('domain=?', (domain,))
+
+
+def del_key(key, domain):
+    with _lock:
+        conn = _get_db()
+        with conn:
+            conn.execute('DELETE FROM items WHERE domain=? AND name=?', (domain, key))
+    return True
+
+
+def find_by_container_id(container_id, domain):
+    return _select('domain=? AND container_id=?', (domain, container_id))
+
+
+def find_by_container_prefix(prefix, domain):
+    # a range scan on the container_id index, every id starting with prefix sorts in [prefix, prefix + U+FFFF)
+    return _select('domain=? AND container_id>=? AND container_id<?', (domain, prefix, prefix + u'\uffff'))
+
+
+def find_by_task_id(task_id, domain):
+    return _select('domain=? AND task_id=?', (domain, task_id))
+
+
+def _find_in(attribute, values, domain):
+    values = list(values)
+    items = []
+    # stay well below sqlite's limit on bound parameters
+    for i in range(0, len(values), 500):
+        chunk = values[i:i + 500]
+        items.extend(_select('domain=? AND {} IN ({})'.format(attribute, ','.join('?' * len(chunk))),
+                             [domain] + chunk))
+    return items
+
+
+def find_by_container_ids(container_ids, domain):
+    return _find_in('container_id', container_ids, domain)
+
+
+def find_by_task_ids(task_ids, domain):
+    return _find_in('task_id', task_ids, domain)
+
+
+def find_by_task_name(task_name, domain):
+    return _select('domain=? AND task_name=?', (domain, task_name))
+
+
+def find_by_sample_time(start, end, domain, desired_status=None):
+    if desired_status is not None:
+        return _select('domain=? AND desired_status=? AND sample_time BETWEEN ? AND ?',
+                       (domain, desired_status, float(start), float(end)))
+    return _select('domain=? AND sample_time BETWEEN ? AND ?', (domain, float(start), float(end)))
+
+
+def find_page(attribute, values, domain, limit, cursor=None):
+    values = list(values)
+    if attribute == 'container_prefix':
+        where = ' OR '.join(['(container_id>=? AND container_id<?)'] * len(values))
+        params = [p for v in values for p in (v, v + u'\uffff')]
+    elif attribute in ('container_id', 'task_id'):
+        where = '{} IN ({})'.format(attribute, ','.join('?' * len(values)))
+        params = values
+    else:
+        raise ValueError('Unable to page by {}'.format(attribute))
+    # keyset pagination on the item name, the cursor is the name of the last item of the previous page
+    where = 'domain=? AND ({}) AND name>? ORDER BY name LIMIT ?'.format(where)
+    items = _select(where, [domain] + params + [cursor or '', int(limit) + 1])
+    if len(items) > limit:
+        return items[:limit], items[limit - 1].name
+    return items, None
+
+
+def select_page(domain, limit, cursor=None, cluster_name=None, desired_status=None):
+    where = 'domain=?'
+    params = [domain]
+    for column, value in (('cluster_name', cluster_name), ('desired_status', desired_status)):
+        if value is not None:
+            where += ' AND {}=?'.format(column)
+            params.append(value)
+    # keyset pagination on the item name, like find_page
+    items = _select(where + ' AND name>? ORDER BY name LIMIT ?', params + [cursor or '', int(limit) + 1])
+    if len(items) > limit:
+        return items[:limit], items[limit - 1].name
+    return items, None
+
+
+def find_by_timestamp(start, end, domain):
+    return _select('domain=? AND timestamp BETWEEN ? AND ?', (domain, float(start), float(end)))
+
+
+def find_events(attribute, value, start, end, domain, limit, cursor=None):
+    if attribute not in ('container_id', 'task_id', 'task_name'):
+        raise ValueError('Unable to look events up by {}'.format(attribute))
+    # keyset pagination on (timestamp, name), the cursor is the last item of the previous page
+    after_timestamp, after_name = json.loads(cursor) if cursor else (float(start), '')
+    items = _select('domain=? AND {a}=? AND timestamp BETWEEN ? AND ? AND (timestamp>? OR (timestamp=? AND name>?)) '
+                    'ORDER BY timestamp, name LIMIT ?'.format(a=attribute),
+                    (domain, value, float(start), float(end), after_timestamp, after_timestamp, after_name,
+                     int(limit) + 1))
+    if len(items) > limit:
+        last = items[limit - 1]
+        return items[:limit], json.dumps([float(last['timestamp']), last.name])
+    return items, None
+
+
+def all_container_ids(domain):
+    with _lock:
+        rows = _get_db().execute('SELECT container_id FROM items WHERE domain=? AND container_id IS NOT NULL',
+                                 (domain,)).fetchall()
+    return [row[0] for row in rows]
+
+
+def list_domains():
+    with _lock:
+        return [row[0] for row in _get_db().execute('SELECT name FROM domains').fetchall()]
+
+
+def delete_domain(domain):
+    with _lock:
+        conn = _get_db()
+        with conn:
+            conn.execute('DELETE FROM items WHERE domain=?', (domain,))
+            conn.execute('DELETE FROM domains WHERE name=?', (domain,))
+    return True
+
+
+def create_domain(domain):
+    with _lock:
+        conn = _get_db()
+        with conn:
+            conn.execute('INSERT OR IGNORE INTO domains (name) VALUES (?)', (domain,))
+    return True
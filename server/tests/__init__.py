@@ -0,0 +1,28 @@
+"""
+Tests of the server modules, run against the sqlite storage backend in a temporary database:
+
+    cd server && python -m unittest discover -s tests -t .
+"""
+import os
+import sys
+import tempfile
+
+_tmp_dir = tempfile.mkdtemp(prefix='ecs_id_mapper_tests')
+os.environ['dev_mode'] = 'true'
+os.environ['storage_backend'] = 'sqlite'
+os.environ['sqlite_path'] = os.path.join(_tmp_dir, 'ecs_id_mapper.db')
+os.environ['write_behind_spool'] = os.path.join(_tmp_dir, 'ecs_id_mapper.spool')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlite_backend
+
+
+def clear_db():
+    """
+    delete every domain and item, call from setUp
+    """
+    with sqlite_backend._lock:
+        conn = sqlite_backend._get_db()
+        with conn:
+            conn.execute('DELETE FROM items')
+            conn.execute('DELETE FROM domains')
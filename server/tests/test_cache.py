@@ -0,0 +1,43 @@
+import time
+import unittest
+from cache import MapCache, CachedItem
+
+
+def row(name, task_id, status):
+    return CachedItem(name, {'container_id': 'c' * 64, 'task_id': task_id, 'desired_status': status})
+
+
+class MapCacheTest(unittest.TestCase):
+    def test_rows_not_read_as_a_whole_are_a_miss(self):
+        cache = MapCache()
+        cache.put('run', row('run', 't1', 'RUNNING'))
+        self.assertEqual(cache.get_by_task_id('t1'), [])
+
+    def test_complete_lookup_is_a_hit(self):
+        cache = MapCache()
+        cache.put_task_rows('t1', [row('run', 't1', 'RUNNING'), row('stop', 't1', 'STOPPED')])
+        self.assertEqual(sorted(r.name for r in cache.get_by_task_id('t1')), ['run', 'stop'])
+        self.assertEqual(len(cache.get_by_container_id('c' * 64)), 0)
+
+    def test_eviction_of_one_row_is_a_miss(self):
+        cache = MapCache(max_entries=2)
+        cache.put_task_rows('t1', [row('run', 't1', 'RUNNING'), row('stop', 't1', 'STOPPED')])
+        cache.put('other', row('other', 't2', 'RUNNING'))
+        self.assertEqual(cache.get_by_task_id('t1'), [])
+
+    def test_rows_written_later_are_included(self):
+        cache = MapCache()
+        cache.put_task_rows('t1', [row('run', 't1', 'RUNNING')])
+        cache.put('stop', row('stop', 't1', 'STOPPED'))
+        cache.invalidate('run')
+        self.assertEqual([r.name for r in cache.get_by_task_id('t1')], ['stop'])
+
+    def test_expired_lookup_is_a_miss(self):
+        cache = MapCache(ttl=0.01)
+        cache.put_task_rows('t1', [row('run', 't1', 'RUNNING')])
+        time.sleep(0.02)
+        self.assertEqual(cache.get_by_task_id('t1'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
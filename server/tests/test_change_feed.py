@@ -0,0 +1,57 @@
+import threading
+import time
+import unittest
+from change_feed import ChangeFeed
+
+
+def publish(feed, count):
+    feed.publish([{'type': 'map', 'name': 'k{}'.format(i)} for i in range(count)])
+
+
+class ChangeFeedTest(unittest.TestCase):
+    def test_read_resumes_after_since(self):
+        feed = ChangeFeed(10)
+        publish(feed, 5)
+        changes, gap = feed.read(2, 2, 0)
+        self.assertEqual([change['seq'] for change in changes], [3, 4])
+        self.assertFalse(gap)
+
+    def test_dropped_changes_are_a_gap(self):
+        feed = ChangeFeed(3)
+        publish(feed, 5)
+        changes, gap = feed.read(0, 10, 0)
+        self.assertEqual([change['seq'] for change in changes], [3, 4, 5])
+        self.assertTrue(gap)
+        changes, gap = feed.read(2, 10, 0)
+        self.assertEqual([change['seq'] for change in changes], [3, 4, 5])
+        self.assertFalse(gap)
+
+    def test_since_from_a_previous_run_resyncs(self):
+        feed = ChangeFeed(3)
+        publish(feed, 2)
+        self.assertEqual(feed.read(7, 10, 0), ([], True))
+
+    def test_up_to_date_reader_waits(self):
+        feed = ChangeFeed(3)
+        publish(feed, 1)
+        self.assertEqual(feed.read(1, 10, 0.01), ([], False))
+        publisher = threading.Timer(0.05, publish, (feed, 1))
+        publisher.start()
+        start = time.time()
+        changes, gap = feed.read(1, 10, 5)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual([change['seq'] for change in changes], [2])
+        self.assertFalse(gap)
+        publisher.join()
+
+    def test_subscribers_are_limited(self):
+        feed = ChangeFeed(3, max_subscribers=1)
+        self.assertTrue(feed.subscribe())
+        self.assertFalse(feed.subscribe())
+        feed.unsubscribe()
+        self.assertTrue(feed.subscribe())
+        self.assertEqual(feed.stats()['subscribers_refused'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import time
+import unittest
+from tests import clear_db
+import db
+from compactor import Compactor
+
+HASH = 'test_hash'
+EVENTS = 'test_events'
+
+
+class ExpireStoppedTest(unittest.TestCase):
+    def setUp(self):
+        clear_db()
+        self.deleted = []
+        self.compactor = Compactor(HASH, EVENTS, stopped_retention=3600, event_retention=3600,
+                                   partition_retention=3600, delete_rate=1000000, on_delete=self.deleted.extend)
+
+    def put_row(self, key, container_id, status, age):
+        db.batch_put({key: {'container_id': container_id, 'task_id': 't-' + container_id, 'desired_status': status,
+                            'sample_time': str(time.time() - age)}}, HASH)
+
+    def test_deletes_every_row_of_an_expired_container(self):
+        self.put_row('run_key', 'c1', 'RUNNING', 7300)
+        self.put_row('stop_key', 'c1', 'STOPPED', 7200)
+        self.assertEqual(self.compactor.expire_stopped(), 2)
+        self.assertEqual(list(db.find_by_container_id('c1', HASH)), [])
+        self.assertEqual(sorted(row.name for row in self.deleted), ['run_key', 'stop_key'])
+
+    def test_keeps_containers_stopped_recently(self):
+        self.put_row('run_key', 'c1', 'RUNNING', 7300)
+        self.put_row('stop_key', 'c1', 'STOPPED', 60)
+        self.put_row('old_running', 'c2', 'RUNNING', 7300)
+        self.assertEqual(self.compactor.expire_stopped(), 0)
+        self.assertEqual(len(db.get_all_dom(HASH)), 3)
+
+    def test_keeps_containers_reported_after_the_cutoff(self):
+        self.put_row('stop_key', 'c1', 'STOPPED', 7200)
+        self.put_row('run_key', 'c1', 'RUNNING', 60)
+        self.assertEqual(self.compactor.expire_stopped(), 0)
+        self.assertEqual(len(db.get_all_dom(HASH)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+from prefix_index import PrefixIndex, AmbiguousPrefixError
+
+A1 = 'abcdef123456' + 'a' * 52
+A2 = 'abcdef654321' + 'b' * 52
+B1 = 'bbbbbb000000' + 'c' * 52
+
+
+class PrefixIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = PrefixIndex()
+        for container_id in (A1, A2, B1):
+            self.index.add(container_id)
+
+    def test_unique_prefix_resolves(self):
+        self.assertEqual(self.index.resolve('abcdef1'), A1)
+        self.assertEqual(self.index.resolve(A2[:12]), A2)
+        self.assertEqual(self.index.resolve('b'), B1)
+        self.assertIsNone(self.index.resolve('abcdef9'))
+
+    def test_shared_prefix_is_ambiguous(self):
+        with self.assertRaises(AmbiguousPrefixError) as raised:
+            self.index.resolve('abcdef')
+        self.assertEqual(raised.exception.count, 2)
+
+    def test_add_is_idempotent(self):
+        self.assertFalse(self.index.add(A1))
+        self.assertEqual(len(self.index), 3)
+
+    def test_remove_updates_counts(self):
+        self.assertTrue(self.index.remove(A2))
+        self.assertFalse(self.index.remove(A2))
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.index._walk('abcdef').count, 1)
+        self.assertIsNone(self.index._walk('abcdef6'))
+        # the prefix shared with A2 is unique now
+        self.assertEqual(self.index.resolve('abcdef'), A1)
+
+    def test_ids_sharing_a_short_id(self):
+        same_short_id = A1[:12] + 'z' * 52
+        self.index.add(same_short_id)
+        self.assertEqual(self.index._walk(A1[:12]).count, 2)
+        self.assertRaises(AmbiguousPrefixError, self.index.resolve, A1[:12])
+        self.index.remove(A1)
+        self.assertEqual(self.index._walk(A1[:12]).count, 1)
+        self.assertEqual(self.index.resolve(A1[:12]), same_short_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import time
+import unittest
+from tests import clear_db
+import db
+
+DOMAIN = 'test_hash'
+
+
+def entry(container_id, task_id, status='RUNNING', sample_time=None):
+    return {'container_id': container_id, 'task_id': task_id, 'task_name': 'web', 'desired_status': status,
+            'sample_time': str(sample_time if sample_time is not None else time.time())}
+
+
+class SqliteBackendTest(unittest.TestCase):
+    def setUp(self):
+        clear_db()
+
+    def test_put_merges_attributes(self):
+        db.batch_put({'k1': entry('c1', 't1')}, DOMAIN)
+        db.batch_put({'k1': {'new_relic_url': 'http://nr'}}, DOMAIN)
+        item = db.get('k1', DOMAIN)
+        self.assertEqual(item.name, 'k1')
+        self.assertEqual(item['container_id'], 'c1')
+        self.assertEqual(item['new_relic_url'], 'http://nr')
+        self.assertIsNone(db.get('missing', DOMAIN))
+
+    def test_batch_put_and_delete(self):
+        db.batch_put(dict(('k{}'.format(i), entry('c{}'.format(i), 't1')) for i in range(30)), DOMAIN)
+        self.assertEqual(len(db.get_all_dom(DOMAIN)), 30)
+        db.batch_delete(['k{}'.format(i) for i in range(10)], DOMAIN)
+        self.assertEqual(len(db.get_all_dom(DOMAIN)), 20)
+        db.del_key('k10', DOMAIN)
+        self.assertEqual(len(db.get_all_dom(DOMAIN)), 19)
+
+    def test_find_by(self):
+        db.batch_put({'k1': entry('abc123', 't1', sample_time=10),
+                      'k2': entry('abc456', 't2', status='STOPPED', sample_time=20),
+                      'k3': entry('def789', 't2', sample_time=30)}, DOMAIN)
+        names = lambda items: sorted(item.name for item in items)
+        self.assertEqual(names(db.find_by_container_id('abc123', DOMAIN)), ['k1'])
+        self.assertEqual(names(db.find_by_container_prefix('abc', DOMAIN)), ['k1', 'k2'])
+        self.assertEqual(names(db.find_by_container_ids(['abc123', 'def789', 'none'], DOMAIN)), ['k1', 'k3'])
+        self.assertEqual(names(db.find_by_task_id('t2', DOMAIN)), ['k2', 'k3'])
+        self.assertEqual(names(db.find_by_task_ids(['t1', 't2'], DOMAIN)), ['k1', 'k2', 'k3'])
+        self.assertEqual(names(db.find_by_task_name('web', DOMAIN)), ['k1', 'k2', 'k3'])
+        self.assertEqual(names(db.find_by_sample_time(15, 30, DOMAIN)), ['k2', 'k3'])
+        self.assertEqual(names(db.find_by_sample_time(0, 30, DOMAIN, desired_status='STOPPED')), ['k2'])
+        self.assertEqual(sorted(db.all_container_ids(DOMAIN)), ['abc123', 'abc456', 'def789'])
+
+    def test_find_page(self):
+        db.batch_put(dict(('k{:02d}'.format(i), entry('c{:02d}'.format(i), 't1')) for i in range(7)), DOMAIN)
+        seen = []
+        cursor = None
+        while True:
+            items, cursor = db.find_page('task_id', ['t1'], DOMAIN, 3, cursor=cursor)
+            seen.extend(item.name for item in items)
+            if cursor is None:
+                break
+        self.assertEqual(seen, ['k{:02d}'.format(i) for i in range(7)])
+        items, cursor = db.find_page('container_prefix', ['c0'], DOMAIN, 10)
+        self.assertEqual(len(items), 7)
+        self.assertIsNone(cursor)
+
+    def test_select_page(self):
+        rows = dict(('k{:02d}'.format(i), entry('c{:02d}'.format(i), 't1', status='RUNNING' if i % 2 else 'STOPPED'))
+                    for i in range(9))
+        for i, attrs in enumerate(sorted(rows.itervalues())):
+            attrs['cluster_name'] = 'prod' if i < 6 else 'test'
+        db.batch_put(rows, DOMAIN)
+
+        def select_all(**filters):
+            seen = []
+            cursor = None
+            while True:
+                items, cursor = db.select_page(DOMAIN, 2, cursor, **filters)
+                seen.extend(items)
+                if cursor is None:
+                    return seen
+        self.assertEqual(len(select_all()), 9)
+        self.assertEqual(len(select_all(cluster_name='prod')), 6)
+        running = select_all(cluster_name='prod', desired_status='RUNNING')
+        self.assertTrue(running)
+        self.assertTrue(all(item['cluster_name'] == 'prod' and item['desired_status'] == 'RUNNING'
+                            for item in running))
+
+    def test_find_events(self):
+        events = dict(('e{}'.format(i), {'container_id': 'c1', 'task_id': 't1', 'task_name': 'web',
+                                         'event': 'added', 'timestamp': str(100 + i % 3)}) for i in range(8))
+        db.batch_put(events, 'test_events')
+        seen = []
+        cursor = None
+        while True:
+            items, cursor = db.find_events('task_id', 't1', 100, 101, 'test_events', 2, cursor=cursor)
+            seen.extend(items)
+            if cursor is None:
+                break
+        self.assertEqual(len(seen), 6)
+        self.assertEqual([float(item['timestamp']) for item in seen], sorted(float(item['timestamp']) for item in seen))
+
+    def test_domains(self):
+        db.create_domain('test_empty')
+        db.batch_put({'k1': entry('c1', 't1')}, DOMAIN)
+        self.assertEqual(sorted(db.list_domains()), ['test_empty', DOMAIN])
+        db.delete_domain(DOMAIN)
+        self.assertEqual(db.list_domains(), ['test_empty'])
+        self.assertEqual(db.get_all_dom(DOMAIN), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from write_behind import WriteBehindBuffer
+
+
+class WriteBehindBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.spool = os.path.join(self.tmp_dir, 'spool')
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def failing_put(self, items, domain):
+        self.calls.append(time.time())
+        raise Exception('DB unavailable')
+
+    def test_failed_flushes_back_off(self):
+        buf = WriteBehindBuffer(self.failing_put, self.spool, flush_interval=0.05, max_retry_delay=0.2)
+        buf.put_many(dict(('item{}'.format(i), {'a': '1'}) for i in range(30)), 'd')
+        buf.start()
+        time.sleep(0.6)
+        # 0.05 + 0.1 + 0.2 + 0.2 ..., a spinning flusher would have made thousands of attempts
+        self.assertTrue(2 <= len(self.calls) <= 6, len(self.calls))
+        self.assertEqual(buf.stats()['pending'], 30)
+        self.assertEqual(buf.retry_delay, 0.2)
+
+    def test_writes_being_flushed_stay_visible(self):
+        written = threading.Event()
+        release = threading.Event()
+
+        def slow_put(items, domain):
+            written.set()
+            release.wait(5)
+        buf = WriteBehindBuffer(slow_put, self.spool)
+        buf.put_many({'host': {'generation': '3'}}, 'hosts')
+        flusher = threading.Thread(target=buf.flush)
+        flusher.start()
+        written.wait(5)
+        self.assertEqual(buf.get('host', 'hosts'), {'generation': '3'})
+        buf.put_many({'host': {'generation': '4'}}, 'hosts')
+        self.assertEqual(buf.get('host', 'hosts'), {'generation': '4'})
+        release.set()
+        flusher.join()
+        self.assertEqual(buf.get('host', 'hosts'), {'generation': '4'})
+
+    def test_find_merges_pending_writes(self):
+        buf = WriteBehindBuffer(self.failing_put, self.spool)
+        buf.put_many({'a': {'container_id': 'c1', 'sample_time': '1'},
+                      'b': {'container_id': 'c2', 'sample_time': '1'}}, 'map')
+        buf.put_many({'a': {'sample_time': '2'}}, 'map')
+        found = buf.find('map', lambda attrs: attrs.get('container_id') == 'c1')
+        self.assertEqual(found, {'a': {'container_id': 'c1', 'sample_time': '2'}})
+        self.assertEqual(buf.find('events', lambda attrs: True), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+from multiprocessing.pool import ThreadPool
+from tornado.wsgi import WSGIContainer
+from tornado.ioloop import IOLoop
+from tornado.log import app_log
+from tornado import escape, httputil
+from tornado.iostream import StreamClosedError
+import tornado
+import threading
+
+
+class ThreadedWSGIContainer(WSGIContainer):
+    """
+    Like tornado's WSGIContainer, but the WSGI application runs on a pool of threads so a slow request doesn't
+    hold up every other request on the IOLoop. The response body is streamed as the application yields it,
+    chunked if the application doesn't set Content-Length, and each write waits for the previous one to be
+    flushed so a large response never sits in memory as a whole.
+    """
+    def __init__(self, wsgi_application, threads):
+        super(ThreadedWSGIContainer, self).__init__(wsgi_application)
+        self.pool = ThreadPool(threads)
+
+    def __call__(self, request):
+        self.pool.apply_async(self._handle, (request, IOLoop.current()))
+
+    @staticmethod
+    def _on_loop(io_loop, fn, *args):
+        """
+        Run fn on the IOLoop and wait until it, and the future it returns if any, is done. Exceptions, such as
+        StreamClosedError when the client went away, are raised in the calling thread.
+        """
+        done = threading.Event()
+        result = {}
+
+        def on_done(future):
+            result['error'] = future.exception()
+            done.set()
+
+        def run():
+            try:
+                future = fn(*args)
+            except Exception as e:
+                result['error'] = e
+                future = None
+            if future is None:
+                done.set()
+            else:
+                io_loop.add_future(future, on_done)
+        io_loop.add_callback(run)
+        done.wait()
+        if result.get('error'):
+            raise result['error']
+
+    @staticmethod
+    def _start_line_and_headers(status, headers):
+        status_code, reason = status.split(' ', 1)
+        status_code = int(status_code)
+        header_set = set(k.lower() for (k, v) in headers)
+        if status_code != 304 and "content-type" not in header_set:
+            headers.append(("Content-Type", "text/html; charset=UTF-8"))
+        if "server" not in header_set:
+            headers.append(("Server", "TornadoServer/%s" % tornado.version))
+        header_obj = httputil.HTTPHeaders()
+        for key, value in headers:
+            header_obj.add(key, value)
+        return status_code, httputil.ResponseStartLine("HTTP/1.1", status_code, reason), header_obj
+
+    def _handle(self, request, io_loop):
+        data = {}
+        chunks = []
+
+        def start_response(status, response_headers, exc_info=None):
+            data["status"] = status
+            data["headers"] = response_headers
+            return chunks.append
+
+        status_code = 500
+        headers_sent = False
+        try:
+            app_response = self.wsgi_application(WSGIContainer.environ(request), start_response)
+            try:
+                for chunk in app_response:
+                    chunks.append(chunk)
+                    body = escape.utf8(b"".join(chunks))
+                    del chunks[:]
+                    if not body:
+                        continue
+                    if not headers_sent:
+                        status_code, start_line, header_obj = self._start_line_and_headers(data["status"],
+                                                                                           data["headers"])
+                        self._on_loop(io_loop, request.connection.write_headers, start_line, header_obj, body)
+                        headers_sent = True
+                    else:
+                        self._on_loop(io_loop, request.connection.write, body)
+            finally:
+                if hasattr(app_response, "close"):
+                    app_response.close()
+            if not data:
+                raise Exception("WSGI app did not call start_response")
+            if not headers_sent:
+                status_code, start_line, header_obj = self._start_line_and_headers(data["status"], data["headers"])
+                body = escape.utf8(b"".join(chunks))
+                if status_code != 304 and "Content-Length" not in header_obj:
+                    header_obj["Content-Length"] = str(len(body))
+                self._on_loop(io_loop, request.connection.write_headers, start_line, header_obj, body)
+            self._on_loop(io_loop, request.connection.finish)
+        except StreamClosedError:
+            # the client closed the connection, e.g. a subscriber of a streamed response went away
+            pass
+        except Exception:
+            app_log.exception("Uncaught exception in WSGI application")
+            if headers_sent:
+                # too late to send an error, drop the connection so the client sees an incomplete response
+                self._on_loop(io_loop, request.connection.close)
+            else:
+                status_code = 500
+                start_line = httputil.ResponseStartLine("HTTP/1.1", 500, "Internal Server Error")
+                self._on_loop(io_loop, request.connection.write_headers, start_line,
+                              httputil.HTTPHeaders({"Content-Length": "0"}), b"")
+                self._on_loop(io_loop, request.connection.finish)
+        io_loop.add_callback(self._log, status_code, request)
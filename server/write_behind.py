@@ -0,0 +1,204 @@
+from collections import OrderedDict
+import threading
+import json
+import time
+import os
+import logging
+
+logger = logging.getLogger('ecs_id_mapper')
+
+
+class WriteBehindBuffer(object):
+    """
+    Buffers writes so they can be acknowledged before they reach the DB. Pending writes to the same item are
+    coalesced and a flusher thread writes them out once a domain has a full batch or flush_interval has passed.
+    Every write is appended to a spool file before it is acknowledged and the spool is rewritten with what is
+    still pending after each flush, so writes survive a crash and are replayed on the next start.
+    """
+    def __init__(self, batch_put, spool_path, flush_interval=1.0, batch_size=25, fsync=True, max_retry_delay=60):
+        """
+        :param batch_put: function. called as batch_put(items, domain) to write a batch to the DB
+        :param spool_path: str. path of the spool file
+        :param flush_interval: float. max seconds a write waits in the buffer
+        :param batch_size: int. flush as soon as a domain has this many pending items
+        :param fsync: bool. fsync the spool on every write
+        :param max_retry_delay: float. cap of the backoff between flushes while the DB fails
+        """
+        self._batch_put = batch_put
+        self.spool_path = spool_path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.max_retry_delay = max_retry_delay
+        self.retry_delay = 0  # seconds the flusher waits before the next flush, doubles with each failed flush
+        self._pending = {}  # domain -> OrderedDict of item name -> attributes
+        self._flushing = {}  # writes taken out of _pending by the flush in progress, still visible to get()
+        self._queued_at = {}  # (domain, item name) -> time the oldest unflushed write to the item was buffered
+        self._cond = threading.Condition()
+        self._flusher = None
+        self.writes = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self.flush_errors = 0
+        self.last_flush_duration = 0
+        self._replay_spool()
+        self._spool = open(self.spool_path, 'a')
+
+    def _replay_spool(self):
+        if not os.path.exists(self.spool_path):
+            return
+        replayed = 0
+        with open(self.spool_path) as spool:
+            for line in spool:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a write cut short by a crash, it was never acknowledged
+                    logger.warning('Skipping truncated entry in write-behind spool')
+                    continue
+                self._buffer(str(entry['domain']), entry['items'])
+                replayed += 1
+        logger.info('Replayed {} writes from write-behind spool {}'.format(replayed, self.spool_path))
+
+    def _buffer(self, domain, items):
+        pending = self._pending.setdefault(domain, OrderedDict())
+        now = time.time()
+        for name, attrs in items.iteritems():
+            if name in pending:
+                self.coalesced += 1
+                pending[name].update(attrs)
+            else:
+                pending[name] = dict(attrs)
+                self._queued_at[(domain, name)] = now
+
+    def put_many(self, items, domain):
+        """
+        Buffer a write. Returns once the write is in the spool.
+        :param items: dict. item name -> attributes
+        :param domain: str. name of the domain to write to
+        """
+        with self._cond:
+            self._spool.write(json.dumps({'domain': domain, 'items': items}) + '\n')
+            self._spool.flush()
+            if self.fsync:
+                os.fsync(self._spool.fileno())
+            self._buffer(domain, items)
+            self.writes += 1
+            if len(self._pending[domain]) >= self.batch_size:
+                self._cond.notify()
+
+    def get(self, key, domain):
+        """
+        :return: dict. attributes of an item not yet written to the DB, None if there is no pending write to it
+        """
+        with self._cond:
+            attrs = None
+            # writes being flushed are older than the ones pending
+            for writes in (self._flushing, self._pending):
+                pending = writes.get(domain, {}).get(key)
+                if pending is not None:
+                    attrs = attrs or {}
+                    attrs.update(pending)
+            return attrs
+
+    def find(self, domain, match):
+        """
+        :param domain: str. domain name
+        :param match: function. called with the attributes of every pending item, True to return it
+        :return: dict. item name -> attributes of the matching items not yet written to the DB
+        """
+        with self._cond:
+            items = {}
+            for writes in (self._flushing, self._pending):
+                for name, attrs in writes.get(domain, {}).iteritems():
+                    items.setdefault(name, {}).update(attrs)
+        return dict((name, attrs) for name, attrs in items.iteritems() if match(attrs))
+
+    def _rewrite_spool(self):
+        """
+        Replace the spool with the writes that are still pending. Called with the lock held.
+        """
+        tmp_path = self.spool_path + '.tmp'
+        with open(tmp_path, 'w') as tmp:
+            for domain, items in self._pending.iteritems():
+                if items:
+                    tmp.write(json.dumps({'domain': domain, 'items': items}) + '\n')
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        self._spool.close()
+        os.rename(tmp_path, self.spool_path)
+        self._spool = open(self.spool_path, 'a')
+
+    def flush(self):
+        """
+        Write everything pending to the DB. Writes that fail are put back in the buffer to be retried.
+        """
+        with self._cond:
+            flushing, self._pending = self._pending, {}
+            self._flushing = flushing
+            queued_at, self._queued_at = self._queued_at, {}
+        start = time.time()
+        failed = {}
+        for domain, items in flushing.iteritems():
+            if not items:
+                continue
+            try:
+                self._batch_put(dict(items), domain)
+                self.flushed += len(items)
+            except Exception as e:
+                logger.error('Unable to flush {} buffered writes to {}: {}'.format(len(items), domain, e))
+                self.flush_errors += 1
+                failed[domain] = items
+        self.last_flush_duration = time.time() - start
+        if failed:
+            self.retry_delay = min(max(self.retry_delay * 2, self.flush_interval), self.max_retry_delay)
+        else:
+            self.retry_delay = 0
+        with self._cond:
+            self._flushing = {}
+            for domain, items in failed.iteritems():
+                # writes buffered during the flush are newer, apply them on top of the failed ones
+                newer = self._pending.get(domain, OrderedDict())
+                for name, attrs in newer.iteritems():
+                    if name in items:
+                        items[name].update(attrs)
+                    else:
+                        items[name] = attrs
+                self._pending[domain] = items
+                for name in items:
+                    self._queued_at[(domain, name)] = min(queued_at.get((domain, name), start),
+                                                          self._queued_at.get((domain, name), start))
+            self._rewrite_spool()
+
+    def _run(self):
+        while True:
+            if self.retry_delay:
+                # the last flush failed, back off before retrying even if a batch is full
+                time.sleep(self.retry_delay)
+            with self._cond:
+                if not self.retry_delay and \
+                        not any(len(items) >= self.batch_size for items in self._pending.itervalues()):
+                    self._cond.wait(self.flush_interval)
+                has_pending = any(self._pending.itervalues())
+            if has_pending:
+                self.flush()
+
+    def start(self):
+        """
+        Start the flusher thread
+        """
+        self._flusher = threading.Thread(target=self._run, name='write_behind_flusher')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def stats(self):
+        with self._cond:
+            oldest = min(self._queued_at.itervalues()) if self._queued_at else None
+            return {'pending': sum(len(items) for items in self._pending.itervalues()),
+                    'flush_lag': time.time() - oldest if oldest else 0,
+                    'writes': self.writes,
+                    'coalesced': self.coalesced,
+                    'flushed': self.flushed,
+                    'flush_errors': self.flush_errors,
+                    'retry_delay': self.retry_delay,
+                    'last_flush_duration': self.last_flush_duration}